@@ -0,0 +1,139 @@
+import asyncio
+import random
+from types import SimpleNamespace
+from pyrogram import raw
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, UserNotParticipant
+
+class FakeClient:
+    """Stand-in for pyrogram.Client that answers the calls the bot makes
+
+    Every call sleeps for a random latency around `latency` seconds.
+    Sends fail with FloodWait at `flood_rate`, and users listed in
+    `blocked` / `deactivated` fail the way Telegram fails for them.
+    get_chat_member reports a user as joined with probability `join_rate`
+    (decided once per user, so repeated checks agree).
+    """
+
+    def __init__(self, latency=0.05, jitter=0.5, flood_rate=0.0, flood_wait=1,
+                 blocked=(), deactivated=(), join_rate=0.8, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.blocked = set(blocked)
+        self.deactivated = set(deactivated)
+        self.join_rate = join_rate
+        self.random = random.Random(seed)
+        self._joined = {}
+        # Storage message IDs that get_messages reports as deleted
+        self.deleted = set()
+        self._next_message_id = 1
+        self.calls = {}
+        # Messages delivered to users (positive chat IDs), not to channels
+        self.deliveries = 0
+
+    async def _call(self, name, chat_id=None, send=False):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self.random.random() - 1)))
+        if send:
+            if self.random.random() < self.flood_rate:
+                raise FloodWait(value=self.flood_wait)
+            if chat_id in self.blocked:
+                raise UserIsBlocked()
+            if chat_id in self.deactivated:
+                raise InputUserDeactivated()
+
+    def _new_message(self, chat_id, count=1):
+        if isinstance(chat_id, int) and chat_id > 0:
+            self.deliveries += count
+        message_id = self._next_message_id
+        self._next_message_id += count
+        return SimpleNamespace(id=message_id, chat=SimpleNamespace(id=chat_id), empty=False)
+
+    def rnd_id(self):
+        return self.random.getrandbits(63)
+
+    async def resolve_peer(self, peer_id):
+        return peer_id
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call("get_chat_member")
+        joined = self._joined.get(user_id)
+        if joined is None:
+            joined = self._joined[user_id] = self.random.random() < self.join_rate
+        if not joined:
+            raise UserNotParticipant()
+        return SimpleNamespace(status=ChatMemberStatus.MEMBER)
+
+    async def get_messages(self, chat_id, message_ids):
+        await self._call("get_messages")
+        if isinstance(message_ids, list):
+            return [SimpleNamespace(id=message_id, empty=message_id in self.deleted) for message_id in message_ids]
+        return FakeMessage(self, chat_id, chat_id, text="Broadcast", message_id=message_ids)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._call("copy_message", chat_id, send=True)
+        return self._new_message(chat_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message", chat_id, send=True)
+        return self._new_message(chat_id)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._call("send_photo", chat_id, send=True)
+        return self._new_message(chat_id)
+
+    send_video = send_document = send_audio = send_photo
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._call("edit_message_text")
+
+    async def invoke(self, query):
+        """Answer messages.ForwardMessages the way Telegram does, with one UpdateMessageID per copy"""
+        await self._call(type(query).__name__, query.to_peer, send=True)
+        first = self._new_message(query.to_peer, len(query.id)).id
+        return SimpleNamespace(updates=[
+            raw.types.UpdateMessageID(id=first + i, random_id=random_id)
+            for i, random_id in enumerate(query.random_id)
+        ])
+
+class FakeMessage:
+    """Incoming private message with the attributes and methods the handlers use"""
+
+    def __init__(self, client, user_id, chat_id=None, text=None, message_id=1, document=None):
+        self.client = client
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=user_id if chat_id is None else chat_id)
+        self.id = message_id
+        self.text = text
+        self.caption = None
+        self.entities = []
+        self.reply_markup = None
+        self.empty = False
+        self.photo = self.video = self.audio = None
+        self.document = document
+        self.command = text[1:].split() if text and text.startswith("/") else None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return await self.client.send_message(self.chat.id, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        await self.client.edit_message_text(self.chat.id, self.id, text, **kwargs)
+
+    async def edit_reply_markup(self, reply_markup=None):
+        await self.client.edit_message_text(self.chat.id, self.id, None, reply_markup=reply_markup)
+
+class FakeCallbackQuery:
+    """Callback query from a button under one of the bot's messages"""
+
+    def __init__(self, client, user_id, data, message):
+        self.client = client
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = message
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        await self.client._call("answer_callback_query")
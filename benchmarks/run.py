@@ -0,0 +1,233 @@
+"""Offline benchmark for the bot's hot paths, driven by a simulated Telegram client
+
+    python benchmarks/run.py --users 10000 --requests 5000 --concurrency 200
+
+Runs four phases against a throwaway database and prints, for each, the
+throughput, p50/p99 handler latency and storage operations per second:
+
+    upload     admin_file_handler storing files
+    start      user_start_handler serving /start deep links
+    callback   check_membership_callback ("Try Again" taps)
+    broadcast  Broadcast.send_broadcast to every user
+
+By default the API rate limits are lifted so the numbers reflect the bot's
+own overhead; pass --api-rate 30 --broadcast-rate 20 to measure with the
+production limits instead.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 42
+STORAGE_CHANNEL_ID = -1001
+FORCE_CHANNELS = "@bench_channel_1,@bench_channel_2"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=10000, help="registered users")
+    parser.add_argument("--files", type=int, default=200, help="files uploaded by the admin")
+    parser.add_argument("--requests", type=int, default=5000, help="/start requests and callback taps")
+    parser.add_argument("--concurrency", type=int, default=200, help="updates handled at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean simulated API latency (s)")
+    parser.add_argument("--flood-rate", type=float, default=0.001, help="share of sends failing with FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=1, help="FloodWait duration (s)")
+    parser.add_argument("--blocked", type=float, default=0.05, help="share of users who blocked the bot")
+    parser.add_argument("--deactivated", type=float, default=0.01, help="share of deleted accounts")
+    parser.add_argument("--join-rate", type=float, default=0.8, help="share of users in the force join channels")
+    parser.add_argument("--api-rate", type=float, default=1e6, help="API_GLOBAL_RATE for the run")
+    parser.add_argument("--broadcast-rate", type=float, default=1e6, help="BROADCAST_RATE for the run")
+    parser.add_argument("--per-chat-interval", type=float, default=0, help="API_PER_CHAT_INTERVAL for the run")
+    parser.add_argument("--delivery-workers", type=int, default=20, help="DELIVERY_WORKERS for the run")
+    parser.add_argument("--backend", default="sqlite", help="STORAGE_BACKEND for the run")
+    parser.add_argument("--log-level", default="ERROR", help="log level for the bot's own logging")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def configure(args, db_path):
+    """Point the bot's configuration at the benchmark before any bot module is imported"""
+    os.environ.update({
+        "API_ID": "1",
+        "API_HASH": "benchmark",
+        "BOT_TOKEN": "1:benchmark",
+        "BOT_USERNAME": "bench_bot",
+        "LINK_SECRET": "benchmark",
+        "STORAGE_CHANNEL_ID": str(STORAGE_CHANNEL_ID),
+        "ADMIN_ID": str(ADMIN_ID),
+        "FORCE_CHANNELS": FORCE_CHANNELS,
+        "DB_PATH": db_path,
+        "STORAGE_BACKEND": args.backend,
+        "METRICS_PORT": "0",
+        "API_GLOBAL_RATE": str(args.api_rate),
+        "API_PER_CHAT_INTERVAL": str(args.per_chat_interval),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "DELIVERY_WORKERS": str(args.delivery_workers),
+        "BROADCAST_PROGRESS_INTERVAL": "3600",
+    })
+    sys.path.insert(0, ROOT)
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def db_ops():
+    """Storage calls recorded so far, across every method"""
+    from utils.metrics import db_latency
+    return sum(child.count for child in db_latency._children.values())
+
+async def drive(handler, updates, concurrency):
+    """Feed updates to handler, at most concurrency at a time; returns per-update latencies"""
+    latencies = []
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async def worker():
+        while not queue.empty():
+            client, update = queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                await handler(client, update)
+            except Exception as e:
+                print(f"  {handler.__name__} raised {type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+def report(name, elapsed, ops_before, latencies=None, **figures):
+    line = f"{name:<10} {elapsed:7.2f}s"
+    for label, value in figures.items():
+        line += f"  {label.replace('_', ' ')} {value:,.0f}"
+    if latencies:
+        line += (
+            f"  p50 {percentile(latencies, 0.5) * 1000:.1f}ms"
+            f"  p99 {percentile(latencies, 0.99) * 1000:.1f}ms"
+        )
+    line += f"  db ops/s {(db_ops() - ops_before) / elapsed:,.0f}"
+    print(line)
+
+async def benchmark(args):
+    from benchmarks.fake_client import FakeClient, FakeMessage, FakeCallbackQuery
+    from handlers import admin_handlers, user_handlers, callback_handlers
+    from storage import get_storage
+    from utils.delivery import get_deep_link_message_ids
+    from utils.delivery_queue import delivery_queue
+    from utils.helpers import membership_callback_data
+    logging.getLogger().setLevel(args.log_level)
+
+    rng = random.Random(args.seed)
+    user_ids = list(range(1000, 1000 + args.users))
+    client = FakeClient(
+        latency=args.latency,
+        flood_rate=args.flood_rate,
+        flood_wait=args.flood_wait,
+        blocked=rng.sample(user_ids, int(args.users * args.blocked)),
+        deactivated=rng.sample(user_ids, int(args.users * args.deactivated)),
+        join_rate=args.join_rate,
+        seed=args.seed,
+    )
+    db = get_storage()
+    # Users who blocked the bot or deleted their account can't send it anything
+    active_ids = [user_id for user_id in user_ids if user_id not in client.blocked | client.deactivated]
+
+    # Register users the way the handlers do, then flush the write-behind buffer
+    for user_id in user_ids:
+        await db.add_user(user_id)
+    await db.flush_users()
+    await db.load_key_filter()
+
+    # upload: the admin sends files one by one
+    uploads = [
+        (client, FakeMessage(client, ADMIN_ID, message_id=i, document=object()))
+        for i in range(1, args.files + 1)
+    ]
+    ops, started = db_ops(), time.perf_counter()
+    latencies = await drive(admin_handlers.admin_file_handler, uploads, min(args.concurrency, 10))
+    report("upload", time.perf_counter() - started, ops, latencies, files_s=args.files / (time.perf_counter() - started))
+
+    # The links are in the admin's replies
+    keys = [
+        key
+        for _, message in uploads
+        for reply in message.replies
+        for key in re.findall(r"start=FILE_([\w-]+)", reply)
+    ]
+    # A key that doesn't resolve would have the later phases time the
+    # "file not found" path instead of deliveries
+    unresolved = [key for key in keys if not await get_deep_link_message_ids(f"FILE_{key}")]
+    if len(keys) != args.files or unresolved:
+        raise SystemExit(
+            f"upload: {len(keys)} links for {args.files} files, {len(unresolved)} not resolving "
+            f"(e.g. {unresolved[:3]})"
+        )
+
+    # start: users open deep links; a few open stale links or just /start
+    updates = []
+    for i in range(args.requests):
+        roll = rng.random()
+        if roll < 0.9:
+            text = f"/start FILE_{rng.choice(keys)}"
+        elif roll < 0.95:
+            text = f"/start FILE_{rng.choice(('0000000000000000', 'guessedkey12345678ab'))}"
+        else:
+            text = "/start"
+        updates.append((client, FakeMessage(client, rng.choice(active_ids), text=text, message_id=i)))
+    deliveries = client.deliveries
+    ops, started = db_ops(), time.perf_counter()
+    latencies = await drive(user_handlers.user_start_handler, updates, args.concurrency)
+    # Handlers only queue deliveries; count until the queue has sent them all
+    await delivery_queue.drain()
+    elapsed = time.perf_counter() - started
+    report("start", elapsed, ops, latencies, deliveries_s=(client.deliveries - deliveries) / elapsed)
+
+    # callback: users tap "Try Again" under the force join prompt
+    updates = []
+    for i in range(args.requests):
+        user_id = rng.choice(active_ids)
+        gate = FakeMessage(client, user_id, text="To access this content, you need to join our channels first.")
+        data = membership_callback_data(f"FILE_{rng.choice(keys)}")
+        updates.append((client, FakeCallbackQuery(client, user_id, data, gate)))
+    deliveries = client.deliveries
+    ops, started = db_ops(), time.perf_counter()
+    latencies = await drive(callback_handlers.check_membership_callback, updates, args.concurrency)
+    await delivery_queue.drain()
+    elapsed = time.perf_counter() - started
+    report(
+        "callback", elapsed, ops, latencies,
+        taps_s=args.requests / elapsed, deliveries_s=(client.deliveries - deliveries) / elapsed
+    )
+
+    # broadcast: one text message to every registered user
+    broadcast = admin_handlers.broadcast
+    broadcast.job = await db.create_broadcast(ADMIN_ID, 1, await db.count_users())
+    broadcast.broadcast_message = await client.get_messages(ADMIN_ID, 1)
+    ops, started = db_ops(), time.perf_counter()
+    await broadcast.send_broadcast(client)
+    elapsed = time.perf_counter() - started
+    job = await db.get_broadcast(broadcast.job["id"])
+    report("broadcast", elapsed, ops, msgs_s=job["successful"] / elapsed, processed=job["processed"])
+
+    await delivery_queue.close()
+    await db.close()
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(args, os.path.join(tmp, "bench.db"))
+        print(
+            f"users {args.users:,}  files {args.files:,}  requests {args.requests:,}  "
+            f"concurrency {args.concurrency}  latency {args.latency * 1000:.0f}ms"
+        )
+        asyncio.run(benchmark(args))
+
+if __name__ == "__main__":
+    main()
@@ -19,19 +19,114 @@ try:
     STORAGE_CHANNEL_ID = int(os.getenv("STORAGE_CHANNEL_ID"))
     FORCE_CHANNEL_1 = os.getenv("FORCE_CHANNEL_1")
     FORCE_CHANNEL_2 = os.getenv("FORCE_CHANNEL_2")
+    # Comma-separated list of channels users must join; falls back to
+    # FORCE_CHANNEL_1 / FORCE_CHANNEL_2 when not set
+    FORCE_CHANNELS = []
+    for channel in os.getenv("FORCE_CHANNELS", f"{FORCE_CHANNEL_1 or ''},{FORCE_CHANNEL_2 or ''}").split(","):
+        channel = channel.strip()
+        if channel:
+            FORCE_CHANNELS.append(int(channel) if channel.lstrip("-").isdigit() else channel)
     ADMIN_ID = int(os.getenv("ADMIN_ID"))
     BOT_USERNAME = os.getenv("BOT_USERNAME", "YourBotName")
+
+    # Storage backend: "sqlite" (single process) or "redis" (shared by several processes)
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    REDIS_PREFIX = os.getenv("REDIS_PREFIX", "file_share_bot:")
+
+    # Metrics endpoint for Prometheus; off unless a port is set. Don't use
+    # 9090, which is the Prometheus server's own port
+    METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+    # Database tuning
+    DB_PATH = os.getenv("DB_PATH", "data/file_share_bot.db")
+    DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+    USER_FLUSH_BATCH_SIZE = int(os.getenv("USER_FLUSH_BATCH_SIZE", "500"))
+    USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+    USER_CHUNK_SIZE = int(os.getenv("USER_CHUNK_SIZE", "1000"))
+    # A user's last_seen is rewritten at most once per this many seconds
+    LAST_SEEN_RESOLUTION = int(os.getenv("LAST_SEEN_RESOLUTION", "3600"))
+    # Users remembered as seen within LAST_SEEN_RESOLUTION, so add_user can skip them
+    KNOWN_USERS_CACHE_SIZE = int(os.getenv("KNOWN_USERS_CACHE_SIZE", "100000"))
+
+    # Per-user limit on private messages: a burst, then a steady rate
+    USER_MESSAGE_RATE = float(os.getenv("USER_MESSAGE_RATE", "0.5"))  # messages per second
+    USER_MESSAGE_BURST = int(os.getenv("USER_MESSAGE_BURST", "5"))
+    USER_LIMITER_SIZE = int(os.getenv("USER_LIMITER_SIZE", "100000"))  # users tracked at most
+    USER_LIMITER_IDLE = float(os.getenv("USER_LIMITER_IDLE", "600"))  # seconds before a user is forgotten
+
+    # Download analytics are kept in memory and flushed this often (seconds)
+    ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "60"))
+
+    # Keys deep-link checksums and "Try Again" button signatures; required,
+    # as anyone could forge them with a known secret. Set it once and never
+    # change it, or every link created before the change stops working
+    LINK_SECRET = os.getenv("LINK_SECRET")
+
+    # In-memory filter of stored keys, to reject made-up keys without a query
+    KEY_FILTER_CAPACITY = int(os.getenv("KEY_FILTER_CAPACITY", "1000000"))
+    KEY_FILTER_ERROR_RATE = float(os.getenv("KEY_FILTER_ERROR_RATE", "0.001"))
+
+    # Deep-link lookup cache
+    FILE_CACHE_SIZE = int(os.getenv("FILE_CACHE_SIZE", "10000"))
+    FILE_CACHE_TTL = float(os.getenv("FILE_CACHE_TTL", "3600"))
+    FILE_CACHE_NEGATIVE_TTL = float(os.getenv("FILE_CACHE_NEGATIVE_TTL", "60"))
+    CACHE_WARM_SIZE = int(os.getenv("CACHE_WARM_SIZE", "500"))  # most delivered links loaded at startup
+
+    # Force-join membership cache and local index
+    MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+    MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))
+    MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "15"))
+    # Stored "joined" answers older than this are checked with Telegram again
+    MEMBERSHIP_MAX_AGE = float(os.getenv("MEMBERSHIP_MAX_AGE", "604800"))  # seconds
+    MEMBERSHIP_FLUSH_INTERVAL = float(os.getenv("MEMBERSHIP_FLUSH_INTERVAL", "5"))  # seconds
+
+    # Outbound Telegram API scheduler
+    API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", "30"))  # calls per second
+    API_PER_CHAT_INTERVAL = float(os.getenv("API_PER_CHAT_INTERVAL", "1"))  # seconds
+    API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "1"))
+    API_MAX_FLOOD_WAIT = float(os.getenv("API_MAX_FLOOD_WAIT", "30"))  # longest FloodWait worth retrying
+
+    # File delivery queue
+    DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "20"))
+    DELIVERY_QUEUE_SIZE = int(os.getenv("DELIVERY_QUEUE_SIZE", "1000"))  # deliveries waiting at most
+    DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "3"))
+
+    # Storage channel integrity sweep; interval 0 disables it
+    SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "86400"))  # seconds between sweeps
+    SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "200"))  # messages per get_messages call, at most 200
+    SWEEP_RATE = float(os.getenv("SWEEP_RATE", "0.5"))  # get_messages calls per second
+
+    # A broadcast or integrity sweep is run by one process at a time: the
+    # one holding its lease, which it renews at every checkpoint. A lease
+    # not renewed for this long is free for another process to take over
+    LEASE_TTL = float(os.getenv("LEASE_TTL", "300"))  # seconds
+
+    # Graceful shutdown: how long to finish in-flight deliveries and
+    # checkpoint a running broadcast after SIGTERM before giving up on them
+    SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "25"))  # seconds
+    SHUTDOWN_DISCONNECT_TIMEOUT = float(os.getenv("SHUTDOWN_DISCONNECT_TIMEOUT", "5"))  # seconds
+
+    # Broadcast engine
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # messages per second
+    BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+    BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+    BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+    BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "500"))  # users
     
     # Validate required environment variables
     required_vars = [
         "API_ID", "API_HASH", "BOT_TOKEN", 
-        "STORAGE_CHANNEL_ID", "FORCE_CHANNEL_1", 
-        "FORCE_CHANNEL_2", "ADMIN_ID"
+        "STORAGE_CHANNEL_ID", "ADMIN_ID", "LINK_SECRET"
     ]
 
     for var in required_vars:
         if not os.getenv(var):
             raise ValueError(f"Missing required environment variable: {var}")
+
+    if not FORCE_CHANNELS:
+        raise ValueError("Missing required environment variable: FORCE_CHANNELS")
             
     logger.info("Configuration loaded successfully")
     
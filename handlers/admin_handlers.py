@@ -2,52 +2,35 @@ import logging
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from utils.helpers import generate_unique_key, create_deep_link
-from database import Database
-from config import ADMIN_ID, STORAGE_CHANNEL_ID, BOT_USERNAME, FORCE_CHANNEL_1, FORCE_CHANNEL_2
+from storage import get_storage
+from config import ADMIN_ID, STORAGE_CHANNEL_ID, BOT_USERNAME, BROADCAST_RATE
 from utils.broadcast import Broadcast
-from utils.force_join import is_user_joined
+from utils.bulk_upload import BulkUpload
+from utils.delivery import handle_deep_link
+from utils.user_limits import allow_message
+from utils.analytics import analytics
+from utils.metrics import timed, handler_latency, handler_errors
+from utils.scheduler import scheduler, INTERACTIVE
 
 logger = logging.getLogger(__name__)
-db = Database()
+db = get_storage()
 broadcast = Broadcast()
+bulk_upload = BulkUpload()
 
 @Client.on_message(filters.command("start") & filters.private)
+@timed(handler_latency, errors=handler_errors)
 async def start_handler(client: Client, message: Message):
     """Handle /start command"""
+    # Spam is shed before it costs a write or an API call
+    if not await allow_message(client, message):
+        return
+    
     # Add user to database
-    db.add_user(message.from_user.id)
+    await db.add_user(message.from_user.id)
     
-    # Check if there's a start parameter (deep link)
-    if len(message.command) > 1:
-        start_param = message.command[1]
-        if start_param.startswith("FILE_"):
-            # This is a file deep link
-            unique_key = start_param[5:]
-            message_id = db.get_file_message_id(unique_key)
-            
-            if message_id:
-                # Check force join
-                if not await is_user_joined(client, message.from_user.id):
-                    await message.reply_text(
-                        "To access this content, you need to join our channels first.\n\n"
-                        "Please join the channels below and then click 'Try Again'.",
-                        reply_markup=get_join_channels_keyboard(FORCE_CHANNEL_1, FORCE_CHANNEL_2)
-                    )
-                    return
-                
-                # Send the file from storage channel
-                try:
-                    await client.copy_message(
-                        chat_id=message.chat.id,
-                        from_chat_id=STORAGE_CHANNEL_ID,
-                        message_id=message_id,
-                        reply_to_message_id=message.id
-                    )
-                    return
-                except Exception as e:
-                    logger.error(f"Error sending file: {str(e)}")
-                    await message.reply_text("❌ Error retrieving the file. Please try again later.")
-                    return
+    # Deliver the file or bundle if this is a deep link
+    if await handle_deep_link(client, message):
+        return
     
     # Regular /start command
     if message.from_user.id == ADMIN_ID:
@@ -59,45 +42,108 @@ async def start_handler(client: Client, message: Message):
                 [InlineKeyboardButton("ℹ️ Help", callback_data="admin_help")]
             ]
         )
-        await message.reply_text(
+        await scheduler.call(
+            INTERACTIVE,
+            message.reply_text,
             "👋 Welcome, Admin!\n\n"
             "You can use the buttons below to manage the bot.",
-            reply_markup=keyboard
+            reply_markup=keyboard,
+            per_chat=message.chat.id
         )
     else:
         # Regular user welcome message
-        await message.reply_text(
+        await scheduler.call(
+            INTERACTIVE,
+            message.reply_text,
             "👋 Welcome to the File Sharing Bot!\n\n"
-            "Send me a file deep link to access shared content."
+            "Send me a file deep link to access shared content.",
+            per_chat=message.chat.id
         )
 
 @Client.on_message(filters.command("broadcast") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
 async def broadcast_command(client: Client, message: Message):
     """Handle /broadcast command"""
     await broadcast.start_broadcast(client, message)
 
+@Client.on_message(filters.command("pausebroadcast") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def pause_broadcast_command(client: Client, message: Message):
+    """Handle /pausebroadcast command"""
+    await broadcast.pause(client, message)
+
+@Client.on_message(filters.command("resumebroadcast") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def resume_broadcast_command(client: Client, message: Message):
+    """Handle /resumebroadcast command"""
+    await broadcast.resume(client, message)
+
+@Client.on_message(filters.command("cancelbroadcast") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def cancel_broadcast_command(client: Client, message: Message):
+    """Handle /cancelbroadcast command"""
+    await broadcast.cancel(client, message)
+
+@Client.on_message(filters.command("bulk") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def bulk_command(client: Client, message: Message):
+    """Handle /bulk command"""
+    await bulk_upload.start(client, message)
+
+@Client.on_message(filters.command("bundle") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def bundle_command(client: Client, message: Message):
+    """Handle /bundle command"""
+    await bulk_upload.start(client, message, as_bundle=True)
+
+@Client.on_message(filters.command("done") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def bulk_done_command(client: Client, message: Message):
+    """Handle /done command"""
+    await bulk_upload.finish(client, message)
+
+@Client.on_message(filters.command("cancelbulk") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def bulk_cancel_command(client: Client, message: Message):
+    """Handle /cancelbulk command"""
+    await bulk_upload.cancel(client, message)
+
+@Client.on_message(filters.command("stats") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
+async def stats_command(client: Client, message: Message):
+    """Handle /stats command"""
+    await analytics.send_report(client, message)
+
 @Client.on_message(filters.private & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
 async def admin_file_handler(client: Client, message: Message):
     """Handle file uploads from admin"""
     # Check if this is part of a broadcast message
     if await broadcast.process_broadcast_message(client, message):
         return
     
+    # Files sent during a bulk upload are collected and stored together on /done
+    if await bulk_upload.add_message(client, message):
+        return
+    
     # Check if the message contains a file
     if not (message.photo or message.video or message.document or message.audio):
         return
     
     try:
         # Copy the file to storage channel
-        copied_message = await client.copy_message(
+        copied_message = await scheduler.call(
+            INTERACTIVE,
+            client.copy_message,
             chat_id=STORAGE_CHANNEL_ID,
             from_chat_id=message.chat.id,
-            message_id=message.id
+            message_id=message.id,
+            per_chat=STORAGE_CHANNEL_ID
         )
         
         # Generate unique key and save to database
         unique_key = generate_unique_key()
-        db.add_file(unique_key, copied_message.id)
+        await db.add_file(unique_key, copied_message.id)
         
         # Create deep link
         deep_link = create_deep_link(BOT_USERNAME, unique_key)
@@ -123,6 +169,7 @@ async def admin_file_handler(client: Client, message: Message):
         await message.reply_text(f"❌ Error uploading file: {str(e)}")
 
 @Client.on_callback_query(filters.regex("^upload_file$") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
 async def upload_file_callback(client: Client, callback_query):
     """Handle upload file callback"""
     await callback_query.answer()
@@ -132,12 +179,14 @@ async def upload_file_callback(client: Client, callback_query):
     )
 
 @Client.on_callback_query(filters.regex("^start_broadcast$") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
 async def start_broadcast_callback(client: Client, callback_query):
     """Handle start broadcast callback"""
     await callback_query.answer()
     await broadcast.start_broadcast(client, callback_query.message)
 
 @Client.on_callback_query(filters.regex("^admin_help$") & filters.user(ADMIN_ID))
+@timed(handler_latency, errors=handler_errors)
 async def admin_help_callback(client: Client, callback_query):
     """Handle admin help callback"""
     await callback_query.answer()
@@ -146,14 +195,24 @@ async def admin_help_callback(client: Client, callback_query):
         "1. **Upload Files**\n"
         "   - Click 'Upload File' or use the command\n"
         "   - Send the file you want to share\n"
-        "   - Get a deep link to share with users\n\n"
+        "   - Get a deep link to share with users\n"
+        "   - Use /bulk to upload many files or albums at once, then /done\n"
+        "   - Use /bundle instead to share them all under a single link\n\n"
         "2. **Broadcast Messages**\n"
         "   - Click 'Broadcast' or use /broadcast\n"
         "   - Send the message to broadcast\n"
         "   - The bot will send it to all users\n"
-        "   - Rate limited to 10 messages/minute\n\n"
-        "3. **Force Join Channels**\n"
-        "   - Users must join both channels to access files\n"
-        "   - Configured in environment variables"
+        "   - /broadcast active 7 targets users active in the last 7 days\n"
+        "   - /broadcast downloaded <link> targets users who received a file\n"
+        f"   - Rate limited to {BROADCAST_RATE:g} messages/second\n"
+        "   - /pausebroadcast, /resumebroadcast and /cancelbroadcast control it\n"
+        "   - Interrupted broadcasts resume automatically on restart\n\n"
+        "3. **Stats**\n"
+        "   - /stats shows the most downloaded links, deliveries per hour\n"
+        "     and how many users got their file after joining the channels\n\n"
+        "4. **Force Join Channels**\n"
+        "   - Users must join all force join channels to access files\n"
+        "   - Configured in environment variables\n"
+        "   - Keep the bot an admin there so joins and leaves are seen as they happen"
     )
     await callback_query.message.edit_text(help_text, parse_mode="markdown")
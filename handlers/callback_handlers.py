@@ -1,51 +1,45 @@
 import logging
 from pyrogram import Client, filters
 from pyrogram.types import CallbackQuery
-from utils.force_join import is_user_joined
-from utils.helpers import get_join_channels_keyboard
-from database import Database
-from config import ADMIN_ID, FORCE_CHANNEL_1, FORCE_CHANNEL_2, STORAGE_CHANNEL_ID
+from utils.force_join import is_user_joined, invalidate_membership
+from utils.helpers import get_start_param_from_callback_data, MEMBERSHIP_CALLBACK_PREFIX
+from utils.delivery import get_deep_link_message_ids, delivery_notice
+from utils.delivery_queue import delivery_queue
+from utils.metrics import timed, handler_latency, handler_errors
 
 logger = logging.getLogger(__name__)
-db = Database()
 
-@Client.on_callback_query(filters.regex("^check_membership$"))
+# chk:... buttons carry the gated start parameter; check_membership is what
+# gate messages sent before that still have
+@Client.on_callback_query(filters.regex(f"^({MEMBERSHIP_CALLBACK_PREFIX}|check_membership$)"))
+@timed(handler_latency, errors=handler_errors)
 async def check_membership_callback(client: Client, callback_query: CallbackQuery):
     """Handle membership check callback"""
-    if await is_user_joined(client, callback_query.from_user.id):
-        # User has joined, get the file ID from the message
-        message = callback_query.message
-        if "FILE_" in message.text:
-            # Extract unique key from the message
-            start_param = None
-            for entity in message.entities:
-                if entity.type == "url":
-                    url = message.text[entity.offset:entity.offset + entity.length]
-                    if "start=FILE_" in url:
-                        start_param = url.split("start=FILE_")[1]
-                        break
-            
-            if start_param:
-                message_id = db.get_file_message_id(start_param)
-                if message_id:
-                    try:
-                        await client.copy_message(
-                            chat_id=callback_query.from_user.id,
-                            from_chat_id=STORAGE_CHANNEL_ID,
-                            message_id=message_id,
-                            reply_to_message_id=callback_query.message.id
-                        )
-                        await callback_query.answer("✅ File sent successfully!")
-                    except Exception as e:
-                        logger.error(f"Error sending file: {str(e)}")
-                        await callback_query.answer("❌ Error retrieving the file. Please try again later.")
-                    return
-        
-        # If we get here, we couldn't find the file ID
-        await callback_query.answer("❌ Could not find the file. Please try the link again.")
-    else:
-        # User still hasn't joined
+    start_param = get_start_param_from_callback_data(callback_query.data)
+    if start_param is None:
+        # Old or tampered button: it doesn't say which file to send
+        await callback_query.answer("❌ Please open the file link again.", show_alert=True)
+        return
+
+    # The user says they have joined now, so don't trust cached or stored
+    # "not joined" answers
+    invalidate_membership(callback_query.from_user.id)
+    if not await is_user_joined(client, callback_query.from_user.id, recheck=True):
         await callback_query.answer("❌ You still need to join the channels!", show_alert=True)
-        await callback_query.message.edit_reply_markup(
-            reply_markup=get_join_channels_keyboard(FORCE_CHANNEL_1, FORCE_CHANNEL_2)
-        )
+        return
+
+    message_ids = await get_deep_link_message_ids(start_param)
+    if not message_ids:
+        await callback_query.answer("❌ Could not find the file. Please try the link again.")
+        return
+
+    status, position = delivery_queue.submit(
+        client,
+        callback_query.from_user.id,
+        callback_query.from_user.id,
+        start_param,
+        message_ids,
+        reply_to_message_id=callback_query.message.id,
+        after_gate=True
+    )
+    await callback_query.answer(delivery_notice(status, position) or "✅ Sending your file...")
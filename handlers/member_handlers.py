@@ -0,0 +1,19 @@
+import logging
+from pyrogram import Client, filters
+from pyrogram.types import ChatMemberUpdated
+from utils.force_join import membership_index, force_channel_for, JOINED_STATUSES
+from utils.metrics import timed, handler_latency, handler_errors
+from config import FORCE_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+@Client.on_chat_member_updated(filters.chat(FORCE_CHANNELS))
+@timed(handler_latency, errors=handler_errors)
+async def force_channel_member_handler(client: Client, update: ChatMemberUpdated):
+    """Keep the membership index current as users join and leave the force channels"""
+    channel = force_channel_for(update.chat)
+    member = update.new_chat_member or update.old_chat_member
+    if channel is None or member is None or member.user is None:
+        return
+    joined = update.new_chat_member is not None and update.new_chat_member.status in JOINED_STATUSES
+    membership_index.record(channel, member.user.id, joined, int(update.date.timestamp()))
@@ -1,10 +1,10 @@
 import logging
 import os
-from pyrogram import Client
-from config import API_ID, API_HASH, BOT_TOKEN
+from pyrogram import Client, idle
+from config import API_ID, API_HASH, BOT_TOKEN, DB_PATH
 
 # Create data directory if it doesn't exist
-os.makedirs("data", exist_ok=True)
+os.makedirs(os.path.dirname(DB_PATH) or "data", exist_ok=True)
 
 # Initialize the bot
 app = Client(
@@ -15,7 +15,15 @@ app = Client(
 )
 
 # Import handlers (must be done after app is initialized)
-from handlers import admin_handlers, user_handlers, callback_handlers
+from handlers import admin_handlers, user_handlers, callback_handlers, member_handlers
+from utils.lifecycle import Lifecycle
+
+async def main():
+    """Run the bot until SIGTERM/SIGINT, then drain in-flight work and flush buffered writes"""
+    lifecycle = Lifecycle(app, admin_handlers.broadcast)
+    await lifecycle.start()
+    await idle()
+    await lifecycle.shutdown()
 
 if __name__ == "__main__":
     logging.info("Starting the bot...")
@@ -23,13 +31,22 @@ if __name__ == "__main__":
     # Register handlers
     app.add_handler(admin_handlers.start_handler)
     app.add_handler(admin_handlers.broadcast_command)
+    app.add_handler(admin_handlers.pause_broadcast_command)
+    app.add_handler(admin_handlers.resume_broadcast_command)
+    app.add_handler(admin_handlers.cancel_broadcast_command)
+    app.add_handler(admin_handlers.bulk_command)
+    app.add_handler(admin_handlers.bundle_command)
+    app.add_handler(admin_handlers.bulk_done_command)
+    app.add_handler(admin_handlers.bulk_cancel_command)
+    app.add_handler(admin_handlers.stats_command)
     app.add_handler(admin_handlers.admin_file_handler)
     app.add_handler(admin_handlers.upload_file_callback)
     app.add_handler(admin_handlers.start_broadcast_callback)
     app.add_handler(admin_handlers.admin_help_callback)
     app.add_handler(user_handlers.user_start_handler)
     app.add_handler(callback_handlers.check_membership_callback)
+    app.add_handler(member_handlers.force_channel_member_handler)
     
     # Start the bot
-    app.run()
+    app.run(main())
     logging.info("Bot stopped.")
@@ -0,0 +1,25 @@
+from config import STORAGE_BACKEND
+from storage.base import Storage, BROADCAST_STAT_FIELDS
+
+def create_storage():
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        from storage.sqlite_backend import SQLiteStorage
+        return SQLiteStorage()
+    if STORAGE_BACKEND == "redis":
+        from storage.redis_backend import RedisStorage
+        return RedisStorage()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+_storage = None
+
+def get_storage():
+    """Return the process-wide storage object, creating it on first call
+
+    Creating it does no I/O; the SQLite backend checks and migrates its
+    schema on first use.
+    """
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
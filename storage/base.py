@@ -0,0 +1,552 @@
+import os
+import secrets
+import socket
+import time
+import weakref
+from config import (
+    logger, LEASE_TTL, USER_FLUSH_BATCH_SIZE, USER_FLUSH_INTERVAL, USER_CHUNK_SIZE,
+    LAST_SEEN_RESOLUTION, KNOWN_USERS_CACHE_SIZE,
+    FILE_CACHE_SIZE, FILE_CACHE_TTL, FILE_CACHE_NEGATIVE_TTL,
+    KEY_FILTER_CAPACITY, KEY_FILTER_ERROR_RATE
+)
+from utils.cache import LRUCache, MISSING
+from utils.flusher import PeriodicFlusher, requeue
+from utils.singleflight import SingleFlight
+from utils.bloom import BloomFilter
+from utils.metrics import metrics, timed, db_latency, rejected_lookups, GAUGE, COUNTER
+
+# Per-job delivery counters stored with each broadcast
+BROADCAST_STAT_FIELDS = ("processed", "successful", "blocked", "deactivated", "flood_wait", "other_errors")
+
+# Integrity sweep progress; cursor is set and finished_at None while a sweep is under way
+SWEEP_STATE_FIELDS = ("cursor", "started_at", "finished_at", "checked", "dead")
+
+def parse_segment(segment):
+    """Turn a broadcast segment into what the backends query
+
+    None means every active user; "active:<days>" users seen in the last
+    <days> days; "downloaded:<start_param>" users who received that link.
+    Returns None, ("active", since_timestamp) or ("downloaded", start_param).
+    """
+    if segment is None:
+        return None
+    kind, _, value = segment.partition(":")
+    if kind == "active" and value.isdigit() and int(value) > 0:
+        return ("active", int(time.time()) - int(value) * 86400)
+    if kind == "downloaded" and value:
+        return ("downloaded", value)
+    raise ValueError(f"Unknown segment: {segment}")
+
+# Every live storage object, for the cache gauges on the metrics endpoint
+_instances = weakref.WeakSet()
+
+def collect_metrics():
+    """Cache and coalescing metrics, summed over every storage object"""
+    caches = {"file": [0, 0, 0], "bundle": [0, 0, 0]}
+    coalescing = {"executed": 0, "coalesced": 0}
+    for storage in list(_instances):
+        for name, cache in (("file", storage.file_cache), ("bundle", storage.bundle_cache)):
+            caches[name][0] += cache.hits
+            caches[name][1] += cache.misses
+            caches[name][2] += len(cache)
+        for field in coalescing:
+            coalescing[field] += getattr(storage.lookups, field)
+    yield "bot_cache_hits_total", COUNTER, "Lookup cache hits", ("cache",), [
+        ((name,), c[0]) for name, c in caches.items()
+    ]
+    yield "bot_cache_misses_total", COUNTER, "Lookup cache misses", ("cache",), [
+        ((name,), c[1]) for name, c in caches.items()
+    ]
+    yield "bot_cache_entries", GAUGE, "Lookup cache entries", ("cache",), [
+        ((name,), c[2]) for name, c in caches.items()
+    ]
+    yield "bot_cache_hit_ratio", GAUGE, "Lookup cache hit ratio", ("cache",), [
+        ((name,), c[0] / (c[0] + c[1]) if c[0] + c[1] else 0.0) for name, c in caches.items()
+    ]
+    yield "bot_lookups_total", COUNTER, "Storage lookups run or coalesced by single-flight", ("result",), [
+        ((field,), value) for field, value in coalescing.items()
+    ]
+
+metrics.register_collector(collect_metrics)
+
+class Storage:
+    """Backend-independent part of the bot's storage
+
+    Handles the in-process layers (write-behind user registration, lookup
+    caches, request coalescing) and error logging. Backends subclass it and
+    implement the underscore-prefixed primitives, which may raise.
+    """
+
+    # True when other processes write to the same store; keys they add would
+    # be missing from this process's key filter, so it is not used
+    shared = False
+
+    def __init__(self):
+        # Write-behind state for add_user: user_id -> the last_seen this
+        # process last wrote for them, kept for LAST_SEEN_RESOLUTION. Users
+        # seen again within it are skipped; the rest are buffered as
+        # user_id -> last_seen and upserted in batches.
+        self._known_users = LRUCache(KNOWN_USERS_CACHE_SIZE, LAST_SEEN_RESOLUTION)
+        self._pending_users = {}
+        # Flushes every USER_FLUSH_INTERVAL seconds, or when the batch fills up
+        self._user_flusher = PeriodicFlusher(self.flush_users, USER_FLUSH_INTERVAL)
+        # Deep-link key -> message_id, with unknown keys cached as None
+        self.file_cache = LRUCache(FILE_CACHE_SIZE, FILE_CACHE_TTL, FILE_CACHE_NEGATIVE_TTL)
+        # Bundle key -> list of message_ids, cached the same way
+        self.bundle_cache = LRUCache(FILE_CACHE_SIZE, FILE_CACHE_TTL, FILE_CACHE_NEGATIVE_TTL)
+        # Coalesces concurrent cache misses for the same key into one query
+        self.lookups = SingleFlight()
+        # Every stored file and bundle key. Consulted once load_key_filter has
+        # run; keys added since startup are added as they are stored.
+        self.key_filter = BloomFilter(KEY_FILTER_CAPACITY, KEY_FILTER_ERROR_RATE)
+        self.key_filter_ready = False
+        # Names this object in leases, unique across processes and restarts
+        self.lease_owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        _instances.add(self)
+
+    async def close(self):
+        """Flush buffered writes, then release the backend's resources"""
+        await self._user_flusher.close()
+        await self._close()
+
+    @timed(db_latency)
+    async def add_user(self, user_id):
+        """Register a user or refresh their last_seen; the write is buffered until the next batched flush"""
+        if self._known_users.get(user_id) is not MISSING:
+            return True
+        now = int(time.time())
+        self._known_users.set(user_id, now)
+        self._pending_users[user_id] = now
+        self._user_flusher.start()
+        if len(self._pending_users) >= USER_FLUSH_BATCH_SIZE:
+            self._user_flusher.wake()
+        return True
+
+    @timed(db_latency)
+    async def flush_users(self):
+        """Write all buffered users and last_seen times in a single batch"""
+        if not self._pending_users:
+            return 0
+        batch, self._pending_users = self._pending_users, {}
+        try:
+            await self._upsert_users(list(batch.items()))
+            return len(batch)
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} users: {str(e)}")
+            # Keep them buffered so the next flush retries
+            requeue(self._pending_users, batch)
+            return 0
+
+    @timed(db_latency)
+    async def deactivate_users(self, entries):
+        """Mark (user_id, reason) pairs inactive in one batch (when blocked/deactivated)"""
+        if not entries:
+            return True
+        for user_id, _ in entries:
+            # Let the next message from them go through add_user and reactivate them
+            self._known_users.invalidate(user_id)
+        try:
+            await self._deactivate_users(entries)
+            return True
+        except Exception as e:
+            logger.error(f"Error deactivating {len(entries)} users: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def count_users(self, segment=None):
+        """Count active users, or those in a broadcast segment (see parse_segment)"""
+        try:
+            return await self._count_users(parse_segment(segment))
+        except Exception as e:
+            logger.error(f"Error counting users: {str(e)}")
+            return 0
+
+    async def iter_users(self, after=0, chunk_size=USER_CHUNK_SIZE, segment=None):
+        """Stream active user IDs greater than after in ascending order, one array chunk at a time
+
+        With a segment (see parse_segment), only users in it are streamed.
+        """
+        segment = parse_segment(segment)
+        while True:
+            try:
+                chunk = await self._get_user_chunk(after, chunk_size, segment)
+            except Exception as e:
+                logger.error(f"Error getting users after {after}: {str(e)}")
+                return
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1]
+
+    async def load_key_filter(self, chunk_size=10000):
+        """Add every stored key to the key filter, then start rejecting unknown keys with it"""
+        if self.shared:
+            return False
+        try:
+            for kind in ("file", "bundle"):
+                after = ""
+                while True:
+                    keys = await self._get_key_chunk(kind, after, chunk_size)
+                    for unique_key in keys:
+                        self.key_filter.add(unique_key)
+                    if len(keys) < chunk_size:
+                        break
+                    after = keys[-1]
+            self.key_filter_ready = True
+            logger.info(f"Key filter loaded with {self.key_filter.count} keys")
+            if self.key_filter.count > self.key_filter.capacity:
+                logger.warning("Key filter is over capacity; raise KEY_FILTER_CAPACITY")
+            return True
+        except Exception as e:
+            logger.error(f"Error loading key filter: {str(e)}")
+            return False
+
+    def _rejected_by_filter(self, unique_key):
+        if self.key_filter_ready and unique_key not in self.key_filter:
+            rejected_lookups.labels("filter").inc()
+            return True
+        return False
+
+    @timed(db_latency)
+    async def add_file(self, unique_key, message_id):
+        """Add a new file mapping"""
+        return await self.add_files([(unique_key, message_id)])
+
+    @timed(db_latency)
+    async def add_files(self, entries):
+        """Add (unique_key, message_id) file mappings in one batch"""
+        for unique_key, _ in entries:
+            self.file_cache.invalidate(unique_key)
+            self.key_filter.add(unique_key)
+        try:
+            await self._add_files(entries)
+            for unique_key, message_id in entries:
+                self.file_cache.set(unique_key, message_id)
+            return True
+        except Exception as e:
+            logger.error(f"Error adding {len(entries)} files: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def get_file_message_id(self, unique_key):
+        """Get message_id for a given unique_key"""
+        if self._rejected_by_filter(unique_key):
+            return None
+        cached = self.file_cache.get(unique_key)
+        if cached is not MISSING:
+            return cached
+        try:
+            # Concurrent requests for the same key share one query
+            message_id = await self.lookups.do(("file", unique_key), self._get_file_message_id, unique_key)
+            self.file_cache.set(unique_key, message_id)
+            return message_id
+        except Exception as e:
+            logger.error(f"Error getting message_id for {unique_key}: {str(e)}")
+            return None
+
+    async def iter_files(self, chunk_size=1000, cursor=None):
+        """Stream the (unique_key, message_id) mappings not flagged dead as (chunk, next cursor) pairs
+
+        Passing a chunk's next cursor back in continues after that chunk;
+        the last chunk's is None.
+        """
+        while True:
+            try:
+                chunk, cursor = await self._get_file_chunk(cursor, chunk_size)
+            except Exception as e:
+                logger.error(f"Error getting files after {cursor}: {str(e)}")
+                return
+            if chunk:
+                yield chunk, cursor
+            if cursor is None:
+                return
+
+    @timed(db_latency)
+    async def mark_files_dead(self, entries):
+        """Flag (unique_key, message_id) mappings whose storage message is gone, so lookups fail fast"""
+        try:
+            await self._mark_files_dead(entries)
+            for unique_key, _ in entries:
+                self.file_cache.set(unique_key, None, ttl=self.file_cache.ttl)
+            return True
+        except Exception as e:
+            logger.error(f"Error marking {len(entries)} files dead: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def get_sweep_state(self):
+        """The integrity sweep's progress as a dict of SWEEP_STATE_FIELDS, or None if it never ran"""
+        try:
+            return await self._get_sweep_state()
+        except Exception as e:
+            logger.error(f"Error getting sweep state: {str(e)}")
+            return None
+
+    @timed(db_latency)
+    async def save_sweep_state(self, state):
+        """Store the integrity sweep's progress so a restart continues from it"""
+        try:
+            await self._save_sweep_state(state)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving sweep state: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def acquire_lease(self, name, ttl=LEASE_TTL):
+        """Take or renew the lease on name for ttl seconds; False while another process holds it"""
+        try:
+            return await self._acquire_lease(name, self.lease_owner, ttl)
+        except Exception as e:
+            logger.error(f"Error acquiring lease {name}: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def release_lease(self, name):
+        """Give up the lease on name if this process holds it"""
+        try:
+            await self._release_lease(name, self.lease_owner)
+            return True
+        except Exception as e:
+            logger.error(f"Error releasing lease {name}: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def add_bundle(self, unique_key, message_ids):
+        """Map one key to an ordered list of storage message_ids"""
+        self.bundle_cache.invalidate(unique_key)
+        self.key_filter.add(unique_key)
+        try:
+            await self._add_bundle(unique_key, list(message_ids))
+            self.bundle_cache.set(unique_key, list(message_ids))
+            return True
+        except Exception as e:
+            logger.error(f"Error adding bundle {unique_key}: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def get_bundle_message_ids(self, unique_key):
+        """Get the ordered message_ids of a bundle, or None if the key is unknown"""
+        if self._rejected_by_filter(unique_key):
+            return None
+        cached = self.bundle_cache.get(unique_key)
+        if cached is not MISSING:
+            return cached
+        try:
+            message_ids = await self.lookups.do(("bundle", unique_key), self._get_bundle_message_ids, unique_key)
+            self.bundle_cache.set(unique_key, message_ids)
+            return message_ids
+        except Exception as e:
+            logger.error(f"Error getting bundle {unique_key}: {str(e)}")
+            return None
+
+    async def warm_caches(self, limit):
+        """Load the most delivered links into the lookup caches; returns how many were loaded"""
+        loaded = 0
+        for stat_key, _, _ in await self.get_top_files(limit):
+            kind, _, unique_key = stat_key.partition("_")
+            if kind == "FILE":
+                found = await self.get_file_message_id(unique_key)
+            elif kind == "BUNDLE":
+                found = await self.get_bundle_message_ids(unique_key)
+            else:
+                continue
+            if found:
+                loaded += 1
+        logger.info(f"Warmed lookup caches with {loaded} links")
+        return loaded
+
+    @timed(db_latency)
+    async def get_memberships(self, user_id):
+        """Stored force channel membership of a user as {channel: (joined, updated_at)}"""
+        try:
+            return await self._get_memberships(user_id)
+        except Exception as e:
+            logger.error(f"Error getting memberships of {user_id}: {str(e)}")
+            return {}
+
+    @timed(db_latency)
+    async def save_memberships(self, entries):
+        """Store (channel, user_id, joined, updated_at) rows in one batch, keeping the newest per pair"""
+        try:
+            await self._save_memberships(entries)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {len(entries)} memberships: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def create_broadcast(self, from_chat_id, message_id, total, segment=None):
+        """Create a running broadcast job to a segment (None for everyone) and return it"""
+        try:
+            job_id = await self._create_broadcast(from_chat_id, message_id, total, segment)
+            return await self._get_broadcast(job_id)
+        except Exception as e:
+            logger.error(f"Error creating broadcast: {str(e)}")
+            return None
+
+    @timed(db_latency)
+    async def get_broadcast(self, job_id):
+        """Get a broadcast job by id"""
+        try:
+            return await self._get_broadcast(job_id)
+        except Exception as e:
+            logger.error(f"Error getting broadcast {job_id}: {str(e)}")
+            return None
+
+    @timed(db_latency)
+    async def get_active_broadcast(self):
+        """Get the latest running or paused broadcast job"""
+        try:
+            return await self._get_active_broadcast()
+        except Exception as e:
+            logger.error(f"Error getting active broadcast: {str(e)}")
+            return None
+
+    @timed(db_latency)
+    async def save_broadcast_progress(self, job_id, cursor, stats):
+        """Checkpoint a broadcast job's cursor and counters"""
+        try:
+            await self._save_broadcast_progress(job_id, cursor, stats)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving progress of broadcast {job_id}: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def set_broadcast_status(self, job_id, status):
+        """Set a broadcast job's status (running, paused, cancelled or completed)"""
+        try:
+            await self._set_broadcast_status(job_id, status)
+            return True
+        except Exception as e:
+            logger.error(f"Error setting status of broadcast {job_id}: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def save_delivery_stats(self, files, hours, downloads=()):
+        """Add aggregated delivery counts in one batch
+
+        files holds (stat_key, deliveries, uniques) where uniques are
+        HyperLogLog registers to merge into the stored ones; hours holds
+        (hour, deliveries, gate_shown, gate_passed) to add; downloads holds
+        (stat_key, user_id) pairs to remember for broadcast segments.
+        """
+        try:
+            await self._save_delivery_stats(files, hours, downloads)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving delivery stats for {len(files)} links: {str(e)}")
+            return False
+
+    @timed(db_latency)
+    async def get_top_files(self, limit=10):
+        """Return (stat_key, deliveries, uniques) for the most delivered links"""
+        try:
+            return await self._get_top_files(limit)
+        except Exception as e:
+            logger.error(f"Error getting top files: {str(e)}")
+            return []
+
+    @timed(db_latency)
+    async def get_hourly_stats(self, since_hour):
+        """Return (hour, deliveries, gate_shown, gate_passed) from since_hour on, oldest first"""
+        try:
+            return await self._get_hourly_stats(since_hour)
+        except Exception as e:
+            logger.error(f"Error getting hourly stats: {str(e)}")
+            return []
+
+    # Backend primitives
+
+    async def _close(self):
+        raise NotImplementedError
+
+    async def _upsert_users(self, entries):
+        """Insert or update (user_id, last_seen) pairs, reactivating any user marked inactive"""
+        raise NotImplementedError
+
+    async def _deactivate_users(self, entries):
+        raise NotImplementedError
+
+    async def _count_users(self, segment):
+        """Count active users in a parsed segment (None for all)"""
+        raise NotImplementedError
+
+    async def _get_user_chunk(self, after, limit, segment):
+        """Return up to limit active user IDs in segment greater than after, ascending, as array('q')"""
+        raise NotImplementedError
+
+    async def _add_files(self, entries):
+        raise NotImplementedError
+
+    async def _get_file_message_id(self, unique_key):
+        raise NotImplementedError
+
+    async def _add_bundle(self, unique_key, message_ids):
+        raise NotImplementedError
+
+    async def _get_bundle_message_ids(self, unique_key):
+        raise NotImplementedError
+
+    async def _get_file_chunk(self, cursor, limit):
+        """Return (about limit live (unique_key, message_id) pairs, next cursor or None when done)
+
+        cursor is None for the first chunk; its meaning is up to the backend.
+        """
+        raise NotImplementedError
+
+    async def _mark_files_dead(self, entries):
+        """Flag (unique_key, message_id) mappings as dead unless the key was remapped since"""
+        raise NotImplementedError
+
+    async def _get_sweep_state(self):
+        raise NotImplementedError
+
+    async def _save_sweep_state(self, state):
+        raise NotImplementedError
+
+    async def _acquire_lease(self, name, owner, ttl):
+        """Set owner as the holder of name for ttl seconds unless another unexpired owner holds it"""
+        raise NotImplementedError
+
+    async def _release_lease(self, name, owner):
+        raise NotImplementedError
+
+    async def _get_key_chunk(self, kind, after, limit):
+        """Return up to limit "file" or "bundle" keys greater than after, ascending"""
+        raise NotImplementedError
+
+    async def _get_memberships(self, user_id):
+        raise NotImplementedError
+
+    async def _save_memberships(self, entries):
+        raise NotImplementedError
+
+    async def _create_broadcast(self, from_chat_id, message_id, total, segment):
+        """Create a running broadcast job and return its id"""
+        raise NotImplementedError
+
+    async def _get_broadcast(self, job_id):
+        """Return a broadcast job as a dict with the broadcasts table's columns, or None"""
+        raise NotImplementedError
+
+    async def _get_active_broadcast(self):
+        raise NotImplementedError
+
+    async def _save_broadcast_progress(self, job_id, cursor, stats):
+        raise NotImplementedError
+
+    async def _set_broadcast_status(self, job_id, status):
+        raise NotImplementedError
+
+    async def _save_delivery_stats(self, files, hours, downloads):
+        raise NotImplementedError
+
+    async def _get_top_files(self, limit):
+        raise NotImplementedError
+
+    async def _get_hourly_stats(self, since_hour):
+        raise NotImplementedError
@@ -0,0 +1,222 @@
+import sqlite3
+from config import logger
+
+# Schema migrations for the SQLite backend, applied in order. The version
+# reached is stored in PRAGMA user_version, so an up-to-date database costs
+# a pragma read and a few no-op index statements at startup.
+#
+# Each migration runs in its own transaction, and holds the write lock
+# for as long as it takes, so keep them cheap on large tables: ADD COLUMN
+# with a NULL or constant default only rewrites the schema, not the rows.
+# Prefer that (and nullable columns filled in as rows are next written)
+# over anything that copies or updates a whole table. Indexes on large
+# tables go in LARGE_TABLE_INDEXES instead of a migration.
+
+def add_column(conn, table, column, definition):
+    """Add a column unless it already exists (databases that predate versioning may have it)"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def initial_schema(conn):
+    """Users, files, bundles and broadcast jobs; databases that predate versioning may have some of them"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        active INTEGER NOT NULL DEFAULT 1,
+        inactive_reason TEXT,
+        inactive_at INTEGER
+    )
+    ''')
+
+    # Databases created before users were soft-deleted lack these columns
+    add_column(conn, "users", "active", "INTEGER NOT NULL DEFAULT 1")
+    add_column(conn, "users", "inactive_reason", "TEXT")
+    add_column(conn, "users", "inactive_at", "INTEGER")
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS files (
+        unique_key TEXT PRIMARY KEY,
+        message_id INTEGER NOT NULL
+    )
+    ''')
+
+    # message_ids is a comma-separated, ordered list of storage channel
+    # message IDs shared under one key
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS bundles (
+        unique_key TEXT PRIMARY KEY,
+        message_ids TEXT NOT NULL
+    )
+    ''')
+
+    # cursor is the last user_id whose delivery has been checkpointed, so a
+    # job resumes after it
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        processed INTEGER NOT NULL DEFAULT 0,
+        successful INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        deactivated INTEGER NOT NULL DEFAULT 0,
+        flood_wait INTEGER NOT NULL DEFAULT 0,
+        other_errors INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    ''')
+
+def index_hot_queries(conn):
+    """Index for finding the active broadcast"""
+    # The active users index this version also built is in
+    # LARGE_TABLE_INDEXES now (as idx_users_active_seen)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+def delivery_stats(conn):
+    """Per-link and per-hour delivery counters"""
+    # uniques holds HyperLogLog registers estimating distinct recipients
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS file_stats (
+        stat_key TEXT PRIMARY KEY,
+        deliveries INTEGER NOT NULL DEFAULT 0,
+        uniques BLOB
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_file_stats_deliveries ON file_stats(deliveries)")
+
+    # hour is the Unix time divided by 3600
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS hourly_stats (
+        hour INTEGER PRIMARY KEY,
+        deliveries INTEGER NOT NULL DEFAULT 0,
+        gate_shown INTEGER NOT NULL DEFAULT 0,
+        gate_passed INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+def activity_tracking(conn):
+    """last_seen for users, who downloaded what, and broadcast segments"""
+    # Unix time of the user's last message, to within LAST_SEEN_RESOLUTION;
+    # NULL for users not seen since this column was added
+    add_column(conn, "users", "last_seen", "INTEGER")
+    # Replaced by idx_users_active_seen, built after the migrations
+    conn.execute("DROP INDEX IF EXISTS idx_users_active")
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS downloads (
+        stat_key TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (stat_key, user_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # NULL for every user, otherwise a segment as understood by parse_segment
+    add_column(conn, "broadcasts", "segment", "TEXT")
+
+def dead_files(conn):
+    """Flag for files whose storage channel message is gone"""
+    # Unix time the integrity sweep found the message missing; NULL while
+    # it exists. Lookups treat flagged files as unknown.
+    add_column(conn, "files", "dead_at", "INTEGER")
+
+def memberships(conn):
+    """Force channel membership as reported by chat member updates"""
+    # channel is the FORCE_CHANNELS entry as configured; keyed by user first
+    # so one range read answers every channel for a user
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS memberships (
+        user_id INTEGER NOT NULL,
+        channel TEXT NOT NULL,
+        joined INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, channel)
+    ) WITHOUT ROWID
+    ''')
+
+def sweep_progress(conn):
+    """Integrity sweep progress, so restarts continue a sweep instead of starting over"""
+    # A single row (id 1). cursor is where the sweep is in files, as the
+    # backend's _get_file_chunk understands it
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS sweep_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        cursor TEXT,
+        started_at INTEGER NOT NULL,
+        finished_at INTEGER,
+        checked INTEGER NOT NULL DEFAULT 0,
+        dead INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+def leases(conn):
+    """Leases that let one of several processes run a broadcast or sweep"""
+    # expires_at is Unix time, as a float; an expired row is free to take
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''')
+
+# (version, migration); versions must increase by one
+MIGRATIONS = [
+    (1, initial_schema),
+    (2, index_hot_queries),
+    (3, delivery_stats),
+    (4, activity_tracking),
+    (5, dead_files),
+    (6, memberships),
+    (7, sweep_progress),
+    (8, leases),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Indexes on the users table, which can hold millions of rows. Building
+# one scans the table under the write lock; inside a migration that lock
+# would be held across the whole migration, so migrate builds these once
+# the schema is current, each in its own statement. Readers carry on
+# meanwhile (WAL), and IF NOT EXISTS makes them no-ops at later startups,
+# or builds one again if a previous startup was interrupted before it.
+LARGE_TABLE_INDEXES = [
+    # Partial: only active users. Covers keyset pages over active users
+    # with or without a last_seen filter, so both are answered from the
+    # index alone, and count_users
+    "CREATE INDEX IF NOT EXISTS idx_users_active_seen ON users(user_id, last_seen) WHERE active = 1",
+    # Range scans for counting "active in the last N days"
+    "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen) WHERE active = 1",
+]
+
+def migrate(db_path):
+    """Bring the database at db_path up to LATEST_VERSION"""
+    # Autocommit mode, so the explicit BEGIN below also covers DDL
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > LATEST_VERSION:
+            raise RuntimeError(f"Database schema version {version} is newer than this bot ({LATEST_VERSION})")
+        for target, migration in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Migrating database to version {target}: {migration.__doc__}")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                migration(conn)
+                # user_version can't be bound as a parameter
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            version = target
+        for statement in LARGE_TABLE_INDEXES:
+            conn.execute(statement)
+        return version
+    finally:
+        conn.close()
@@ -0,0 +1,347 @@
+import time
+from array import array
+from config import logger, REDIS_URL, REDIS_PREFIX
+from storage.base import Storage, BROADCAST_STAT_FIELDS, SWEEP_STATE_FIELDS
+from utils.hyperloglog import HyperLogLog
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:
+    # Without the package only an injected stand-in client can be used
+    class WatchError(Exception):
+        """A watched key changed before the transaction ran"""
+
+class RedisStorage(Storage):
+    """Storage on a Redis server, shared by any number of bot processes
+
+    Every write is a single command or a MULTI/EXEC pipeline, so concurrent
+    workers never see a half-applied batch. Writes that depend on what is
+    stored (merges, newest-wins) run under WATCH and are retried if another
+    process changed the keys in between. Layout, under REDIS_PREFIX:
+
+        users               sorted set of active user IDs (score = user_id)
+        users:inactive      hash user_id -> "reason:timestamp"
+        users:last_seen     sorted set of active user IDs (score = last_seen)
+        files               hash unique_key -> message_id
+        files:dead          hash unique_key -> "message_id:timestamp" of files
+                            whose storage message is gone (moved out of files)
+        bundles             hash unique_key -> comma-separated message_ids
+        broadcast:next_id   counter for broadcast job IDs
+        broadcast:<id>      hash with the same fields as the SQLite table
+        broadcasts:active   sorted set of running/paused job IDs
+        file_stats          sorted set stat_key -> deliveries
+        file_stats:uniques  hash stat_key -> hex HyperLogLog registers
+        hourly:<hour>       hash deliveries/gate_shown/gate_passed
+        downloads:<stat_key> sorted set of user IDs who received a link
+        membership:<user_id> hash channel -> "joined:updated_at"
+        sweep               hash with the integrity sweep's progress, as in
+                            the SQLite sweep_state table
+        lease:<name>        owner of a lease, expiring with it
+    """
+
+    # Other bot processes add keys too
+    shared = True
+
+    def __init__(self, url=REDIS_URL, prefix=REDIS_PREFIX, client=None):
+        super().__init__()
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("STORAGE_BACKEND=redis needs the redis package: pip install redis")
+            client = redis.from_url(url, decode_responses=True)
+        # Any redis.asyncio-compatible client created with decode_responses=True
+        self.redis = client
+        self.prefix = prefix
+        logger.info(f"Using Redis storage with prefix {prefix!r}")
+
+    def _key(self, name):
+        return f"{self.prefix}{name}"
+
+    async def _close(self):
+        close = getattr(self.redis, "aclose", None) or self.redis.close
+        await close()
+
+    async def _transaction(self, keys, apply):
+        """Run apply(pipe) with keys watched, retrying until no other client changed them first
+
+        apply reads through pipe (the reads run immediately), then calls
+        pipe.multi() and queues its writes, which EXEC applies atomically.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(*keys)
+                    await apply(pipe)
+                    return await pipe.execute()
+                except WatchError:
+                    continue
+
+    async def _upsert_users(self, entries):
+        user_ids = [user_id for user_id, _ in entries]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zadd(self._key("users"), {user_id: user_id for user_id in user_ids})
+        pipe.zadd(self._key("users:last_seen"), dict(entries))
+        # Returning users who had been marked inactive are reactivated
+        pipe.hdel(self._key("users:inactive"), *user_ids)
+        await pipe.execute()
+
+    async def _deactivate_users(self, entries):
+        now = int(time.time())
+        user_ids = [user_id for user_id, _ in entries]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrem(self._key("users"), *user_ids)
+        pipe.zrem(self._key("users:last_seen"), *user_ids)
+        pipe.hset(
+            self._key("users:inactive"),
+            mapping={user_id: f"{reason}:{now}" for user_id, reason in entries}
+        )
+        await pipe.execute()
+
+    async def _count_users(self, segment):
+        if segment is None:
+            return await self.redis.zcard(self._key("users"))
+        kind, value = segment
+        if kind == "active":
+            return await self.redis.zcount(self._key("users:last_seen"), value, "+inf")
+        # May include users deactivated since; the chunks skip them
+        return await self.redis.zcard(self._key(f"downloads:{value}"))
+
+    async def _get_user_chunk(self, after, limit, segment):
+        if segment is None:
+            user_ids = await self.redis.zrangebyscore(
+                self._key("users"), f"({after}", "+inf", start=0, num=limit
+            )
+            return array("q", (int(user_id) for user_id in user_ids))
+
+        # Walk the candidate set in user_id order and keep the members of the
+        # segment, until limit are found or the candidates run out
+        kind, value = segment
+        if kind == "active":
+            source, check = self._key("users"), self._key("users:last_seen")
+        else:
+            source, check = self._key(f"downloads:{value}"), self._key("users")
+        chunk = array("q")
+        while len(chunk) < limit:
+            user_ids = await self.redis.zrangebyscore(source, f"({after}", "+inf", start=0, num=limit)
+            if not user_ids:
+                break
+            scores = await self.redis.zmscore(check, user_ids)
+            for user_id, score in zip(user_ids, scores):
+                if score is not None and (kind != "active" or score >= value):
+                    chunk.append(int(user_id))
+                    if len(chunk) == limit:
+                        break
+            after = int(user_ids[-1])
+        return chunk
+
+    async def _add_files(self, entries):
+        await self.redis.hset(self._key("files"), mapping=dict(entries))
+
+    async def _get_file_message_id(self, unique_key):
+        message_id = await self.redis.hget(self._key("files"), unique_key)
+        return int(message_id) if message_id is not None else None
+
+    async def _get_file_chunk(self, cursor, limit):
+        # HSCAN may return a few more or fewer than limit; a cursor of 0 means done
+        cursor, mapping = await self.redis.hscan(self._key("files"), cursor or 0, count=limit)
+        entries = [(unique_key, int(message_id)) for unique_key, message_id in mapping.items()]
+        return entries, cursor or None
+
+    async def _mark_files_dead(self, entries):
+        files = self._key("files")
+        keys = [unique_key for unique_key, _ in entries]
+
+        async def apply(pipe):
+            current = await pipe.hmget(files, keys)
+            now = int(time.time())
+            # A key remapped since the sweep read it is left alone
+            dead = {
+                unique_key: f"{message_id}:{now}"
+                for (unique_key, message_id), stored in zip(entries, current)
+                if stored is not None and int(stored) == message_id
+            }
+            pipe.multi()
+            if dead:
+                pipe.hdel(files, *dead)
+                pipe.hset(self._key("files:dead"), mapping=dead)
+
+        await self._transaction([files], apply)
+
+    async def _get_sweep_state(self):
+        state = await self.redis.hgetall(self._key("sweep"))
+        if not state:
+            return None
+        # The cursor stays a string; HSCAN takes it as one
+        return {
+            field: (value if field == "cursor" else int(value)) if value else None
+            for field, value in state.items()
+        }
+
+    async def _save_sweep_state(self, state):
+        # Hashes can't hold None; "" stands for it
+        await self.redis.hset(
+            self._key("sweep"),
+            mapping={field: "" if state[field] is None else state[field] for field in SWEEP_STATE_FIELDS}
+        )
+
+    async def _acquire_lease(self, name, owner, ttl):
+        key = self._key(f"lease:{name}")
+        acquired = False
+
+        async def apply(pipe):
+            nonlocal acquired
+            holder = await pipe.get(key)
+            acquired = holder is None or holder == owner
+            pipe.multi()
+            if acquired:
+                pipe.set(key, owner, px=int(ttl * 1000))
+
+        await self._transaction([key], apply)
+        return acquired
+
+    async def _release_lease(self, name, owner):
+        key = self._key(f"lease:{name}")
+
+        async def apply(pipe):
+            holder = await pipe.get(key)
+            pipe.multi()
+            if holder == owner:
+                pipe.delete(key)
+
+        await self._transaction([key], apply)
+
+    async def _add_bundle(self, unique_key, message_ids):
+        await self.redis.hset(
+            self._key("bundles"),
+            unique_key,
+            ",".join(str(message_id) for message_id in message_ids)
+        )
+
+    async def _get_bundle_message_ids(self, unique_key):
+        message_ids = await self.redis.hget(self._key("bundles"), unique_key)
+        return [int(message_id) for message_id in message_ids.split(",")] if message_ids else None
+
+    async def _get_memberships(self, user_id):
+        rows = await self.redis.hgetall(self._key(f"membership:{user_id}"))
+        memberships = {}
+        for channel, value in rows.items():
+            joined, _, updated_at = value.partition(":")
+            memberships[channel] = (joined == "1", int(updated_at))
+        return memberships
+
+    async def _save_memberships(self, entries):
+        latest = {}
+        for channel, user_id, joined, updated_at in entries:
+            current = latest.get((user_id, channel))
+            if current is None or updated_at >= current[1]:
+                latest[(user_id, channel)] = (joined, updated_at)
+        pairs = list(latest)
+
+        async def apply(pipe):
+            stored = [await pipe.hget(self._key(f"membership:{user_id}"), channel) for user_id, channel in pairs]
+            pipe.multi()
+            # An update that arrives late must not overwrite a newer one
+            for (user_id, channel), value in zip(pairs, stored):
+                joined, updated_at = latest[(user_id, channel)]
+                if value is None or updated_at >= int(value.partition(":")[2]):
+                    pipe.hset(self._key(f"membership:{user_id}"), channel, f"{int(joined)}:{updated_at}")
+
+        await self._transaction(sorted({self._key(f"membership:{user_id}") for user_id, _ in pairs}), apply)
+
+    async def _create_broadcast(self, from_chat_id, message_id, total, segment):
+        job_id = await self.redis.incr(self._key("broadcast:next_id"))
+        now = int(time.time())
+        job = {
+            "id": job_id,
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "status": "running",
+            "cursor": 0,
+            "total": total,
+            # Hashes can't hold None; "" means every user
+            "segment": segment or "",
+            "created_at": now,
+            "updated_at": now,
+        }
+        job.update({field: 0 for field in BROADCAST_STAT_FIELDS})
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self._key(f"broadcast:{job_id}"), mapping=job)
+        pipe.zadd(self._key("broadcasts:active"), {job_id: job_id})
+        await pipe.execute()
+        return job_id
+
+    async def _get_broadcast(self, job_id):
+        job = await self.redis.hgetall(self._key(f"broadcast:{job_id}"))
+        if not job:
+            return None
+        job = {field: value if field in ("status", "segment") else int(value) for field, value in job.items()}
+        job["segment"] = job.get("segment") or None
+        return job
+
+    async def _get_active_broadcast(self):
+        job_ids = await self.redis.zrevrange(self._key("broadcasts:active"), 0, 0)
+        return await self._get_broadcast(job_ids[0]) if job_ids else None
+
+    async def _save_broadcast_progress(self, job_id, cursor, stats):
+        progress = {field: stats[field] for field in BROADCAST_STAT_FIELDS}
+        progress.update(cursor=cursor, updated_at=int(time.time()))
+        await self.redis.hset(self._key(f"broadcast:{job_id}"), mapping=progress)
+
+    async def _set_broadcast_status(self, job_id, status):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(
+            self._key(f"broadcast:{job_id}"),
+            mapping={"status": status, "updated_at": int(time.time())}
+        )
+        if status in ("cancelled", "completed"):
+            pipe.zrem(self._key("broadcasts:active"), job_id)
+        await pipe.execute()
+
+    async def _save_delivery_stats(self, files, hours, downloads):
+        uniques_key = self._key("file_stats:uniques")
+        stat_keys = [stat_key for stat_key, _, _ in files]
+
+        async def apply(pipe):
+            stored = await pipe.hmget(uniques_key, stat_keys) if stat_keys else []
+            pipe.multi()
+            for (stat_key, deliveries, uniques), registers in zip(files, stored):
+                # Merging takes the larger of each register; WATCH makes sure
+                # no other process's merge landed since the read
+                sketch = HyperLogLog(registers=uniques)
+                if registers:
+                    sketch.merge(bytes.fromhex(registers))
+                pipe.zincrby(self._key("file_stats"), deliveries, stat_key)
+                pipe.hset(uniques_key, stat_key, sketch.registers.hex())
+            for hour, deliveries, gate_shown, gate_passed in hours:
+                key = self._key(f"hourly:{hour}")
+                pipe.hincrby(key, "deliveries", deliveries)
+                pipe.hincrby(key, "gate_shown", gate_shown)
+                pipe.hincrby(key, "gate_passed", gate_passed)
+            for stat_key, user_id in downloads:
+                pipe.zadd(self._key(f"downloads:{stat_key}"), {user_id: user_id})
+
+        await self._transaction([uniques_key], apply)
+
+    async def _get_top_files(self, limit):
+        top = await self.redis.zrevrange(self._key("file_stats"), 0, limit - 1, withscores=True)
+        if not top:
+            return []
+        stored = await self.redis.hmget(self._key("file_stats:uniques"), [stat_key for stat_key, _ in top])
+        return [
+            (stat_key, int(deliveries), bytes.fromhex(registers) if registers else None)
+            for (stat_key, deliveries), registers in zip(top, stored)
+        ]
+
+    async def _get_hourly_stats(self, since_hour):
+        now_hour = int(time.time() // 3600)
+        hours = list(range(since_hour, now_hour + 1))
+        pipe = self.redis.pipeline(transaction=False)
+        for hour in hours:
+            pipe.hgetall(self._key(f"hourly:{hour}"))
+        rows = await pipe.execute()
+        return [
+            (hour, int(row.get("deliveries", 0)), int(row.get("gate_shown", 0)), int(row.get("gate_passed", 0)))
+            for hour, row in zip(hours, rows)
+            if row
+        ]
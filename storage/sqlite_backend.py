@@ -0,0 +1,350 @@
+import asyncio
+import sqlite3
+import time
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from config import logger, DB_PATH, DB_READ_POOL_SIZE
+from storage.base import Storage, BROADCAST_STAT_FIELDS, SWEEP_STATE_FIELDS
+from storage.migrations import migrate
+from utils.hyperloglog import HyperLogLog
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside
+# the single writer, and synchronous=NORMAL only fsyncs at checkpoints.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+class SQLiteStorage(Storage):
+    """Storage in a local SQLite file, for a single bot process"""
+
+    def __init__(self, db_path=DB_PATH, read_pool_size=DB_READ_POOL_SIZE):
+        super().__init__()
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # All writes go through one thread so they never contend for the lock;
+        # reads are spread over a small pool of long-lived connections.
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="db-reader")
+        # The schema is checked on first use, on a pool thread, so that
+        # creating the storage object costs no I/O
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def get_connection(self):
+        """Return the calling thread's long-lived connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.init_db()
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _read(self, func, *args):
+        """Run func(conn, *args) on the reader pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, lambda: func(self.get_connection(), *args))
+
+    async def _write(self, func, *args):
+        """Run func(conn, *args) in a transaction on the writer thread"""
+        def run():
+            conn = self.get_connection()
+            with conn:
+                # Take the write lock before func reads anything; otherwise
+                # sqlite3 only begins at the first write, and another process
+                # could commit between a read and the write based on it
+                conn.execute("BEGIN IMMEDIATE")
+                return func(conn, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, run)
+
+    def init_db(self):
+        """Create or migrate the schema; runs once, on the first connection"""
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            try:
+                version = migrate(self.db_path)
+                logger.info(f"Database initialized successfully (schema version {version})")
+            except Exception as e:
+                logger.error(f"Error initializing database: {str(e)}")
+                raise
+            self._schema_ready = True
+
+    async def _close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    async def _upsert_users(self, entries):
+        def upsert(conn):
+            # Returning users who had been marked inactive are reactivated
+            conn.executemany(
+                "INSERT INTO users (user_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen, "
+                "active = 1, inactive_reason = NULL, inactive_at = NULL",
+                entries
+            )
+        await self._write(upsert)
+
+    async def _deactivate_users(self, entries):
+        def deactivate(conn):
+            now = int(time.time())
+            conn.executemany(
+                "UPDATE users SET active = 0, inactive_reason = ?, inactive_at = ? WHERE user_id = ?",
+                ((reason, now, user_id) for user_id, reason in entries)
+            )
+        await self._write(deactivate)
+
+    async def _count_users(self, segment):
+        def count(conn):
+            if segment is None:
+                return conn.execute("SELECT COUNT(*) FROM users WHERE active = 1").fetchone()[0]
+            kind, value = segment
+            if kind == "active":
+                return conn.execute(
+                    "SELECT COUNT(*) FROM users WHERE active = 1 AND last_seen >= ?", (value,)
+                ).fetchone()[0]
+            return conn.execute(
+                "SELECT COUNT(*) FROM downloads d JOIN users u ON u.user_id = d.user_id "
+                "WHERE d.stat_key = ? AND u.active = 1",
+                (value,)
+            ).fetchone()[0]
+        return await self._read(count)
+
+    async def _get_user_chunk(self, after, limit, segment):
+        def chunk(conn):
+            if segment is None:
+                cursor = conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? AND active = 1 ORDER BY user_id LIMIT ?",
+                    (after, limit)
+                )
+            elif segment[0] == "active":
+                cursor = conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? AND active = 1 AND last_seen >= ? "
+                    "ORDER BY user_id LIMIT ?",
+                    (after, segment[1], limit)
+                )
+            else:
+                cursor = conn.execute(
+                    "SELECT d.user_id FROM downloads d JOIN users u ON u.user_id = d.user_id "
+                    "WHERE d.stat_key = ? AND d.user_id > ? AND u.active = 1 ORDER BY d.user_id LIMIT ?",
+                    (segment[1], after, limit)
+                )
+            return array("q", (row[0] for row in cursor))
+        return await self._read(chunk)
+
+    async def _add_files(self, entries):
+        def add(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO files (unique_key, message_id) VALUES (?, ?)",
+                entries
+            )
+        await self._write(add)
+
+    async def _get_file_message_id(self, unique_key):
+        def get(conn):
+            result = conn.execute(
+                "SELECT message_id FROM files WHERE unique_key = ? AND dead_at IS NULL",
+                (unique_key,)
+            ).fetchone()
+            return result[0] if result else None
+        return await self._read(get)
+
+    async def _get_file_chunk(self, cursor, limit):
+        def chunk(conn):
+            rows = conn.execute(
+                "SELECT unique_key, message_id FROM files WHERE unique_key > ? AND dead_at IS NULL "
+                "ORDER BY unique_key LIMIT ?",
+                (cursor or "", limit)
+            ).fetchall()
+            return rows, rows[-1][0] if len(rows) == limit else None
+        return await self._read(chunk)
+
+    async def _mark_files_dead(self, entries):
+        def mark(conn):
+            now = int(time.time())
+            conn.executemany(
+                "UPDATE files SET dead_at = ? WHERE unique_key = ? AND message_id = ?",
+                ((now, unique_key, message_id) for unique_key, message_id in entries)
+            )
+        await self._write(mark)
+
+    async def _get_sweep_state(self):
+        def get(conn):
+            row = conn.execute(f"SELECT {', '.join(SWEEP_STATE_FIELDS)} FROM sweep_state WHERE id = 1").fetchone()
+            return dict(zip(SWEEP_STATE_FIELDS, row)) if row else None
+        return await self._read(get)
+
+    async def _save_sweep_state(self, state):
+        def save(conn):
+            conn.execute(
+                f"INSERT OR REPLACE INTO sweep_state (id, {', '.join(SWEEP_STATE_FIELDS)}) VALUES (1, ?, ?, ?, ?, ?)",
+                tuple(state[field] for field in SWEEP_STATE_FIELDS)
+            )
+        await self._write(save)
+
+    async def _acquire_lease(self, name, owner, ttl):
+        def acquire(conn):
+            now = time.time()
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                (name, owner, now + ttl, now)
+            )
+            return conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0] == owner
+        return await self._write(acquire)
+
+    async def _release_lease(self, name, owner):
+        def release(conn):
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+        await self._write(release)
+
+    async def _add_bundle(self, unique_key, message_ids):
+        def add(conn):
+            conn.execute(
+                "INSERT OR REPLACE INTO bundles (unique_key, message_ids) VALUES (?, ?)",
+                (unique_key, ",".join(str(message_id) for message_id in message_ids))
+            )
+        await self._write(add)
+
+    async def _get_bundle_message_ids(self, unique_key):
+        def get(conn):
+            result = conn.execute(
+                "SELECT message_ids FROM bundles WHERE unique_key = ?",
+                (unique_key,)
+            ).fetchone()
+            return [int(message_id) for message_id in result[0].split(",")] if result else None
+        return await self._read(get)
+
+    async def _get_key_chunk(self, kind, after, limit):
+        table = {"file": "files", "bundle": "bundles"}[kind]
+        def chunk(conn):
+            rows = conn.execute(
+                f"SELECT unique_key FROM {table} WHERE unique_key > ? ORDER BY unique_key LIMIT ?",
+                (after, limit)
+            )
+            return [row[0] for row in rows]
+        return await self._read(chunk)
+
+    async def _get_memberships(self, user_id):
+        def get(conn):
+            rows = conn.execute(
+                "SELECT channel, joined, updated_at FROM memberships WHERE user_id = ?", (user_id,)
+            )
+            return {channel: (bool(joined), updated_at) for channel, joined, updated_at in rows}
+        return await self._read(get)
+
+    async def _save_memberships(self, entries):
+        def save(conn):
+            # An update that arrives late must not overwrite a newer one
+            conn.executemany(
+                "INSERT INTO memberships (channel, user_id, joined, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id, channel) DO UPDATE SET joined = excluded.joined, "
+                "updated_at = excluded.updated_at WHERE excluded.updated_at >= memberships.updated_at",
+                ((channel, user_id, int(joined), updated_at) for channel, user_id, joined, updated_at in entries)
+            )
+        await self._write(save)
+
+    async def _create_broadcast(self, from_chat_id, message_id, total, segment):
+        def create(conn):
+            now = int(time.time())
+            cursor = conn.execute(
+                "INSERT INTO broadcasts (from_chat_id, message_id, total, segment, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (from_chat_id, message_id, total, segment, now, now)
+            )
+            return cursor.lastrowid
+        return await self._write(create)
+
+    def _select_broadcast(self, conn, where, params):
+        cursor = conn.execute(
+            f"SELECT * FROM broadcasts WHERE {where} ORDER BY id DESC LIMIT 1",
+            params
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip((column[0] for column in cursor.description), row))
+
+    async def _get_broadcast(self, job_id):
+        return await self._read(self._select_broadcast, "id = ?", (job_id,))
+
+    async def _get_active_broadcast(self):
+        return await self._read(self._select_broadcast, "status IN ('running', 'paused')", ())
+
+    async def _save_broadcast_progress(self, job_id, cursor, stats):
+        def save(conn):
+            conn.execute(
+                "UPDATE broadcasts SET cursor = ?, "
+                + ", ".join(f"{field} = ?" for field in BROADCAST_STAT_FIELDS)
+                + ", updated_at = ? WHERE id = ?",
+                (cursor, *(stats[field] for field in BROADCAST_STAT_FIELDS), int(time.time()), job_id)
+            )
+        await self._write(save)
+
+    async def _set_broadcast_status(self, job_id, status):
+        def update(conn):
+            conn.execute(
+                "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ?",
+                (status, int(time.time()), job_id)
+            )
+        await self._write(update)
+
+    async def _save_delivery_stats(self, files, hours, downloads):
+        def save(conn):
+            for stat_key, deliveries, uniques in files:
+                row = conn.execute(
+                    "SELECT uniques FROM file_stats WHERE stat_key = ?", (stat_key,)
+                ).fetchone()
+                sketch = HyperLogLog(registers=uniques)
+                if row is not None:
+                    sketch.merge(row[0])
+                conn.execute(
+                    "INSERT INTO file_stats (stat_key, deliveries, uniques) VALUES (?, ?, ?) "
+                    "ON CONFLICT(stat_key) DO UPDATE SET "
+                    "deliveries = deliveries + excluded.deliveries, uniques = excluded.uniques",
+                    (stat_key, deliveries, bytes(sketch.registers))
+                )
+            conn.executemany(
+                "INSERT INTO hourly_stats (hour, deliveries, gate_shown, gate_passed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(hour) DO UPDATE SET "
+                "deliveries = deliveries + excluded.deliveries, "
+                "gate_shown = gate_shown + excluded.gate_shown, "
+                "gate_passed = gate_passed + excluded.gate_passed",
+                hours
+            )
+            conn.executemany("INSERT OR IGNORE INTO downloads (stat_key, user_id) VALUES (?, ?)", downloads)
+        await self._write(save)
+
+    async def _get_top_files(self, limit):
+        def get(conn):
+            return conn.execute(
+                "SELECT stat_key, deliveries, uniques FROM file_stats ORDER BY deliveries DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return await self._read(get)
+
+    async def _get_hourly_stats(self, since_hour):
+        def get(conn):
+            return conn.execute(
+                "SELECT hour, deliveries, gate_shown, gate_passed FROM hourly_stats "
+                "WHERE hour >= ? ORDER BY hour",
+                (since_hour,)
+            ).fetchall()
+        return await self._read(get)
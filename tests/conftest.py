@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# config.py validates these at import time
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "test")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("STORAGE_CHANNEL_ID", "-1001")
+os.environ.setdefault("ADMIN_ID", "42")
+os.environ.setdefault("LINK_SECRET", "test")
+os.environ.setdefault("FORCE_CHANNELS", "@test_channel")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,271 @@
+import asyncio
+import itertools
+import time
+from storage.redis_backend import WatchError
+
+def _encode(value):
+    """Store values the way Redis does: as strings"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _bound(value):
+    """Parse a ZRANGEBYSCORE/ZCOUNT bound into (score, exclusive)"""
+    if isinstance(value, str):
+        if value.startswith("("):
+            return float(value[1:]), True
+        return float(value), False
+    return float(value), False
+
+def _in_range(score, low, high):
+    (low, low_open), (high, high_open) = low, high
+    return (score > low if low_open else score >= low) and (score < high if high_open else score <= high)
+
+class FakeRedis:
+    """In-memory stand-in for a redis.asyncio client created with decode_responses=True
+
+    Implements the commands RedisStorage uses with Redis semantics: values
+    come back as strings, sorted sets order by (score, member), and
+    WATCH/MULTI/EXEC fails with WatchError when a watched key was written in
+    between. Every command yields to the event loop first, like a network
+    round trip, so concurrent callers interleave the way separate processes
+    sharing a server would; a transaction's queued commands apply at once.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._versions = {}  # key -> number of writes, for WATCH
+        self._hash_order = {}  # key -> {field: insertion number}, for HSCAN cursors
+        self._counter = itertools.count(1)
+        self._expires = {}  # key -> time.time() it expires at
+        self.closed = False
+
+    def __getattr__(self, name):
+        command = getattr(type(self), f"_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            await asyncio.sleep(0)
+            return command(self, *args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def aclose(self):
+        self.closed = True
+
+    def _touch(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _fetch(self, key, kind):
+        self._expire(key)
+        value = self._data.get(key)
+        return kind() if value is None else value
+
+    def _store(self, key, value):
+        if value:
+            self._data[key] = value
+        else:
+            self._data.pop(key, None)
+            self._hash_order.pop(key, None)
+        self._touch(key)
+
+    def _expire(self, key):
+        """Drop key if its expiry has passed, as Redis does on access"""
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            del self._expires[key]
+            self._data.pop(key, None)
+
+    # Keys
+
+    def _delete(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._fetch(key, lambda: None) is not None:
+                removed += 1
+                self._store(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    # Strings
+
+    def _get(self, key):
+        return self._fetch(key, lambda: None)
+
+    def _set(self, key, value, px=None, nx=False):
+        if nx and self._get(key) is not None:
+            return None
+        self._store(key, _encode(value))
+        self._expires.pop(key, None)
+        if px is not None:
+            self._expires[key] = time.time() + px / 1000
+        return True
+
+    def _incr(self, key):
+        value = int(self._fetch(key, lambda: 0)) + 1
+        self._store(key, str(value))
+        return value
+
+    # Hashes
+
+    def _hset(self, key, field=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        hash_ = dict(self._fetch(key, dict))
+        order = self._hash_order.setdefault(key, {})
+        added = 0
+        for field, value in items.items():
+            field = _encode(field)
+            if field not in hash_:
+                added += 1
+                order[field] = next(self._counter)
+            hash_[field] = _encode(value)
+        self._store(key, hash_)
+        return added
+
+    def _hget(self, key, field):
+        return self._fetch(key, dict).get(_encode(field))
+
+    def _hmget(self, key, fields):
+        hash_ = self._fetch(key, dict)
+        return [hash_.get(_encode(field)) for field in fields]
+
+    def _hgetall(self, key):
+        return dict(self._fetch(key, dict))
+
+    def _hdel(self, key, *fields):
+        hash_ = dict(self._fetch(key, dict))
+        removed = 0
+        for field in map(_encode, fields):
+            if hash_.pop(field, None) is not None:
+                removed += 1
+                self._hash_order.get(key, {}).pop(field, None)
+        self._store(key, hash_)
+        return removed
+
+    def _hincrby(self, key, field, amount=1):
+        value = int(self._fetch(key, dict).get(_encode(field), 0)) + amount
+        self._hset(key, field, value)
+        return value
+
+    def _hscan(self, key, cursor=0, count=None):
+        """Fields inserted at or after cursor, in insertion order
+
+        Like Redis, a field present for the whole scan is returned exactly
+        once however the hash changes in between.
+        """
+        hash_ = self._fetch(key, dict)
+        order = self._hash_order.get(key, {})
+        fields = sorted((number, field) for field, number in order.items() if number >= int(cursor))
+        page = fields[:count or 10]
+        next_cursor = page[-1][0] + 1 if len(fields) > len(page) else 0
+        return next_cursor, {field: hash_[field] for _, field in page}
+
+    # Sorted sets
+
+    def _sorted(self, key):
+        return sorted(self._fetch(key, dict).items(), key=lambda item: (item[1], item[0]))
+
+    def _zadd(self, key, mapping):
+        zset = dict(self._fetch(key, dict))
+        added = 0
+        for member, score in mapping.items():
+            member = _encode(member)
+            if member not in zset:
+                added += 1
+            zset[member] = float(score)
+        self._store(key, zset)
+        return added
+
+    def _zrem(self, key, *members):
+        zset = dict(self._fetch(key, dict))
+        removed = sum(zset.pop(_encode(member), None) is not None for member in members)
+        self._store(key, zset)
+        return removed
+
+    def _zincrby(self, key, amount, member):
+        score = self._fetch(key, dict).get(_encode(member), 0.0) + amount
+        self._zadd(key, {member: score})
+        return score
+
+    def _zcard(self, key):
+        return len(self._fetch(key, dict))
+
+    def _zcount(self, key, min, max):
+        low, high = _bound(min), _bound(max)
+        return sum(_in_range(score, low, high) for score in self._fetch(key, dict).values())
+
+    def _zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        low, high = _bound(min), _bound(max)
+        items = [(member, score) for member, score in self._sorted(key) if _in_range(score, low, high)]
+        if start is not None:
+            items = items[start:start + num if num is not None and num >= 0 else None]
+        return items if withscores else [member for member, _ in items]
+
+    def _zrevrange(self, key, start, end, withscores=False):
+        items = list(reversed(self._sorted(key)))
+        items = items[start:None if end == -1 else end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    def _zmscore(self, key, members):
+        zset = self._fetch(key, dict)
+        return [zset.get(_encode(member)) for member in members]
+
+class FakePipeline:
+    """Pipeline of a FakeRedis: commands queue until execute
+
+    After watch() commands run immediately (and return their results)
+    until multi() starts queueing the transaction.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+        self._watched = None
+        self._immediate = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.reset()
+
+    def __getattr__(self, name):
+        if self._immediate:
+            return getattr(self._redis, name)
+        command = getattr(type(self._redis), f"_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def watch(self, *keys):
+        await asyncio.sleep(0)
+        self._watched = {key: self._redis._versions.get(key, 0) for key in keys}
+        self._immediate = True
+
+    def multi(self):
+        self._immediate = False
+
+    def reset(self):
+        self._commands = []
+        self._watched = None
+        self._immediate = False
+
+    async def execute(self):
+        await asyncio.sleep(0)
+        try:
+            if self._watched is not None and any(
+                self._redis._versions.get(key, 0) != version for key, version in self._watched.items()
+            ):
+                raise WatchError("Watched variable changed.")
+            return [command(self._redis, *args, **kwargs) for command, args, kwargs in self._commands]
+        finally:
+            self.reset()
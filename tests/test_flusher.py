@@ -0,0 +1,53 @@
+import asyncio
+
+from utils.flusher import PeriodicFlusher, requeue
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_flushes_on_interval_and_wake():
+    async def scenario():
+        flushes = []
+
+        async def flush():
+            flushes.append(asyncio.get_running_loop().time())
+            return True
+
+        flusher = PeriodicFlusher(flush, 0.05)
+        flusher.start()
+        await asyncio.sleep(0.08)
+        assert len(flushes) == 1
+        flusher.wake()
+        await asyncio.sleep(0.01)
+        assert len(flushes) == 2
+        assert await flusher.close() is True
+        assert len(flushes) == 3
+    run(scenario())
+
+def test_close_waits_for_flush_in_progress():
+    async def scenario():
+        buffer = {"a": 1}
+        stored = {}
+        started = asyncio.Event()
+
+        async def flush():
+            batch = dict(buffer)
+            buffer.clear()
+            started.set()
+            await asyncio.sleep(0.05)
+            stored.update(batch)
+            return True
+
+        flusher = PeriodicFlusher(flush, 60)
+        flusher.start()
+        flusher.wake()
+        await started.wait()
+        buffer["b"] = 2
+        await flusher.close()
+        assert stored == {"a": 1, "b": 2}
+    run(scenario())
+
+def test_requeue_keeps_newer_entries():
+    pending = {"a": 2}
+    requeue(pending, {"a": 1, "b": 1})
+    assert pending == {"a": 2, "b": 1}
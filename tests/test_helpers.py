@@ -0,0 +1,76 @@
+import asyncio
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from utils.helpers import (
+    generate_unique_key, is_valid_key, membership_callback_data, get_start_param_from_callback_data,
+    copy_messages, MAX_MESSAGES_PER_CALL
+)
+
+class FakeClient:
+    """Copies messages as ForwardMessages would, with a FloodWait on one call"""
+
+    def __init__(self, flood_on_call=None):
+        self.flood_on_call = flood_on_call
+        self.calls = 0
+        self.sent = []
+        self._random_id = 0
+
+    async def resolve_peer(self, chat_id):
+        return chat_id
+
+    def rnd_id(self):
+        self._random_id += 1
+        return self._random_id
+
+    async def invoke(self, query):
+        self.calls += 1
+        if self.calls == self.flood_on_call:
+            raise FloodWait(value=1)
+        self.sent.extend(query.id)
+        return raw.types.Updates(
+            updates=[
+                raw.types.UpdateMessageID(id=1000 + message_id, random_id=random_id)
+                for message_id, random_id in zip(query.id, query.random_id)
+            ],
+            users=[], chats=[], date=0, seq=0
+        )
+
+def test_generated_keys_are_valid():
+    key = generate_unique_key()
+    assert is_valid_key(key)
+    assert not is_valid_key(key[:-1] + ("A" if key[-1] != "A" else "B"))
+
+def test_legacy_keys_are_valid():
+    assert is_valid_key("0123456789abcdef")
+    assert not is_valid_key("0123456789abcdeg")
+
+def test_non_ascii_key_is_rejected():
+    assert not is_valid_key("aaaaaaaaaaaaaaaaéééé")
+    assert not is_valid_key("ééééééééééééééééaaaa")
+
+def test_membership_callback_data_round_trip():
+    data = membership_callback_data("FILE_abc")
+    assert get_start_param_from_callback_data(data) == "FILE_abc"
+    # Pointed at another key without re-signing
+    assert get_start_param_from_callback_data(data.replace("FILE_abc", "FILE_abd")) is None
+    assert get_start_param_from_callback_data("check_membership") is None
+
+def test_non_ascii_callback_signature_is_rejected():
+    assert get_start_param_from_callback_data("chk:FILE_x:é") is None
+    assert get_start_param_from_callback_data("chk:FILE_é:" + "a" * 8) is None
+
+def test_copy_messages_resumes_after_flood_wait():
+    async def scenario():
+        message_ids = list(range(1, 2 * MAX_MESSAGES_PER_CALL + 11))
+        client = FakeClient(flood_on_call=2)
+        copied = []
+        try:
+            await copy_messages(client, 1, 2, message_ids, copied)
+        except FloodWait:
+            pass
+        assert copied == [1000 + message_id for message_id in message_ids[:MAX_MESSAGES_PER_CALL]]
+        # Trying again sends only what the first attempt did not
+        result = await copy_messages(client, 1, 2, message_ids, copied)
+        assert result == [1000 + message_id for message_id in message_ids]
+        assert client.sent == message_ids
+    asyncio.run(scenario())
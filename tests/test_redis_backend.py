@@ -0,0 +1,62 @@
+import asyncio
+from storage.redis_backend import RedisStorage
+from fake_redis import FakeRedis
+
+# Behaviour shared with the SQLite backend is tested in test_storage.py;
+# these cover the Redis key layout and transactions
+
+def make_storage(redis=None):
+    return RedisStorage(client=redis or FakeRedis(), prefix="test:")
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_deactivated_users_key_layout():
+    async def scenario():
+        db = make_storage()
+        await db._upsert_users([(1, 100), (2, 200)])
+        await db._deactivate_users([(2, "blocked")])
+        assert (await db.redis.hget("test:users:inactive", 2)).startswith("blocked:")
+        await db._upsert_users([(2, 400)])
+        assert await db.redis.hget("test:users:inactive", 2) is None
+        assert await db.redis.zmscore("test:users:last_seen", [2]) == [400.0]
+    run(scenario())
+
+def test_dead_files_key_layout():
+    async def scenario():
+        db = make_storage()
+        await db._add_files([("a", 1)])
+        await db._mark_files_dead([("a", 1)])
+        assert (await db.redis.hget("test:files:dead", "a")).startswith("1:")
+    run(scenario())
+
+def test_mark_files_dead_retries_when_key_is_remapped_meanwhile(monkeypatch):
+    read = FakeRedis._hmget
+    remapped = []
+
+    def hmget_then_remap(self, key, fields):
+        result = read(self, key, fields)
+        if not remapped:
+            # Another process remaps the key right after the sweep's read
+            remapped.append(True)
+            self._hset("test:files", "a", 99)
+        return result
+
+    async def scenario():
+        db = make_storage()
+        await db._add_files([("a", 1)])
+        monkeypatch.setattr(FakeRedis, "_hmget", hmget_then_remap)
+        await db._mark_files_dead([("a", 1)])
+        assert await db._get_file_message_id("a") == 99
+        assert await db.redis.hget("test:files:dead", "a") is None
+    run(scenario())
+
+def test_close():
+    async def scenario():
+        redis = FakeRedis()
+        db = make_storage(redis)
+        await db.add_user(5)
+        await db.close()
+        # Buffered users are flushed before the connection is released
+        assert redis.closed and await redis.zcard("test:users") == 1
+    run(scenario())
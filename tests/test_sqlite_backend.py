@@ -0,0 +1,77 @@
+import asyncio
+import sqlite3
+from storage.sqlite_backend import SQLiteStorage
+from storage.migrations import migrate, LATEST_VERSION
+
+# Behaviour shared with the Redis backend is tested in test_storage.py
+
+def run(coro):
+    return asyncio.run(coro)
+
+def create_baseline_database(path):
+    """The schema the bot had before migrations, with some data in it"""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY)")
+    conn.execute("CREATE TABLE files (unique_key TEXT PRIMARY KEY, message_id INTEGER NOT NULL)")
+    conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(1,), (2,), (3,)])
+    conn.execute("INSERT INTO files (unique_key, message_id) VALUES ('legacykey', 7)")
+    conn.commit()
+    conn.close()
+
+def schema_of(path):
+    conn = sqlite3.connect(path)
+    try:
+        names = {
+            (kind, name)
+            for kind, name in conn.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'")
+        }
+        return conn.execute("PRAGMA user_version").fetchone()[0], names
+    finally:
+        conn.close()
+
+def test_migrates_baseline_database(tmp_path):
+    baseline, fresh = str(tmp_path / "baseline.db"), str(tmp_path / "fresh.db")
+    create_baseline_database(baseline)
+
+    assert migrate(baseline) == LATEST_VERSION
+    assert migrate(fresh) == LATEST_VERSION
+    # Migrating an old database ends with the same schema as a new one
+    version, objects = schema_of(baseline)
+    assert version == LATEST_VERSION
+    assert objects == schema_of(fresh)[1]
+    for table in ("users", "files", "bundles", "broadcasts", "file_stats", "hourly_stats",
+                  "downloads", "memberships", "sweep_state", "leases"):
+        assert ("table", table) in objects
+    for index in ("idx_broadcasts_status", "idx_users_active_seen", "idx_users_last_seen"):
+        assert ("index", index) in objects
+    # Running it again is a no-op
+    assert migrate(baseline) == LATEST_VERSION
+
+def test_existing_data_survives_migration(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    create_baseline_database(path)
+
+    async def scenario():
+        db = SQLiteStorage(db_path=path)
+        try:
+            # Users from before soft deletion are active; their last_seen is unknown
+            assert await db._count_users(None) == 3
+            assert list(await db._get_user_chunk(0, 10, ("active", 0))) == []
+            assert await db._get_file_message_id("legacykey") == 7
+            await db._upsert_users([(2, 100)])
+            assert list(await db._get_user_chunk(0, 10, ("active", 0))) == [2]
+        finally:
+            await db._close()
+    run(scenario())
+
+def test_rejects_newer_schema(tmp_path):
+    path = str(tmp_path / "future.db")
+    conn = sqlite3.connect(path)
+    conn.execute(f"PRAGMA user_version = {LATEST_VERSION + 1}")
+    conn.close()
+    try:
+        migrate(path)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("migrate accepted a database from a newer version")
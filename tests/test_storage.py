@@ -0,0 +1,240 @@
+import asyncio
+import time
+import pytest
+from storage.redis_backend import RedisStorage
+from storage.sqlite_backend import SQLiteStorage
+from fake_redis import FakeRedis
+from utils.hyperloglog import HyperLogLog
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_storage(request, tmp_path):
+    """Factory for storage objects of one backend, all sharing one store"""
+    redis = FakeRedis()
+    created = []
+
+    def make():
+        if request.param == "sqlite":
+            db = SQLiteStorage(db_path=str(tmp_path / "test.db"))
+        else:
+            db = RedisStorage(client=redis, prefix="test:")
+        created.append(db)
+        return db
+
+    yield make
+    for db in created:
+        asyncio.run(db._close())
+
+def run(coro):
+    return asyncio.run(coro)
+
+def sketch_of(user_ids):
+    sketch = HyperLogLog()
+    for user_id in user_ids:
+        sketch.add(user_id)
+    return bytes(sketch.registers)
+
+def test_upsert_and_deactivate_users(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._upsert_users([(1, 100), (2, 200), (3, 300)])
+        await db._deactivate_users([(2, "blocked")])
+        assert await db._count_users(None) == 2
+        assert list(await db._get_user_chunk(0, 10, None)) == [1, 3]
+        # Coming back reactivates and refreshes last_seen
+        await db._upsert_users([(2, 400)])
+        assert await db._count_users(None) == 3
+        assert list(await db._get_user_chunk(0, 10, ("active", 350))) == [2]
+    run(scenario())
+
+def test_count_and_chunk_users_by_segment(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._upsert_users([(user_id, 1000 if user_id <= 5 else 5000) for user_id in range(1, 11)])
+        await db._save_delivery_stats([], [], [("FILE_a", 3), ("FILE_a", 7), ("FILE_a", 9)])
+        await db._deactivate_users([(9, "blocked")])
+
+        assert await db._count_users(("active", 2000)) == 4
+        assert list(await db._get_user_chunk(0, 3, None)) == [1, 2, 3]
+        assert list(await db._get_user_chunk(3, 100, None)) == [4, 5, 6, 7, 8, 10]
+        assert list(await db._get_user_chunk(0, 2, ("active", 2000))) == [6, 7]
+        assert list(await db._get_user_chunk(7, 2, ("active", 2000))) == [8, 10]
+        # Deactivated downloaders are skipped
+        assert list(await db._get_user_chunk(0, 10, ("downloaded", "FILE_a"))) == [3, 7]
+    run(scenario())
+
+def test_files_and_chunks(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._add_files([(f"key{i:03d}", i) for i in range(25)])
+        assert await db._get_file_message_id("key007") == 7
+        assert await db._get_file_message_id("missing") is None
+
+        seen, cursor = {}, None
+        while True:
+            entries, cursor = await db._get_file_chunk(cursor, 10)
+            seen.update(entries)
+            if cursor is None:
+                break
+        assert seen == {f"key{i:03d}": i for i in range(25)}
+    run(scenario())
+
+def test_mark_files_dead(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._add_files([("a", 1), ("b", 2)])
+        # b was remapped to another message since it was read
+        await db._mark_files_dead([("a", 1), ("b", 3)])
+        assert await db._get_file_message_id("a") is None
+        assert await db._get_file_message_id("b") == 2
+    run(scenario())
+
+def test_bundles(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._add_bundle("bundle", [5, 3, 9])
+        assert await db._get_bundle_message_ids("bundle") == [5, 3, 9]
+        assert await db._get_bundle_message_ids("missing") is None
+    run(scenario())
+
+def test_memberships_keep_the_newest(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db._save_memberships([("@a", 1, True, 200), ("@a", 1, False, 100), ("@b", 1, False, 150)])
+        assert await db._get_memberships(1) == {"@a": (True, 200), "@b": (False, 150)}
+        # A late, older update doesn't win
+        await db._save_memberships([("@a", 1, False, 190)])
+        assert (await db._get_memberships(1))["@a"] == (True, 200)
+        assert await db._get_memberships(2) == {}
+    run(scenario())
+
+def test_concurrent_membership_saves_keep_the_newest(make_storage):
+    async def scenario():
+        first, second = make_storage(), make_storage()
+        # Both read before either writes; the older one must not land last
+        await asyncio.gather(
+            first._save_memberships([("@a", 1, True, 200)]),
+            second._save_memberships([("@a", 1, False, 100)])
+        )
+        assert await first._get_memberships(1) == {"@a": (True, 200)}
+    run(scenario())
+
+def test_broadcast_jobs(make_storage):
+    async def scenario():
+        db = make_storage()
+        first = await db._create_broadcast(42, 7, 100, None)
+        second = await db._create_broadcast(42, 8, 10, "active:7")
+        assert (await db._get_active_broadcast())["id"] == second
+
+        job = await db._get_broadcast(second)
+        assert job["segment"] == "active:7" and job["status"] == "running" and job["total"] == 10
+        assert (await db._get_broadcast(first))["segment"] is None
+        assert await db._get_broadcast(999) is None
+
+        stats = {"processed": 5, "successful": 3, "blocked": 1, "deactivated": 0, "flood_wait": 1, "other_errors": 0}
+        await db._save_broadcast_progress(second, 55, stats)
+        job = await db._get_broadcast(second)
+        assert job["cursor"] == 55 and job["successful"] == 3
+
+        await db._set_broadcast_status(second, "paused")
+        assert (await db._get_active_broadcast())["status"] == "paused"
+        await db._set_broadcast_status(second, "completed")
+        assert (await db._get_active_broadcast())["id"] == first
+    run(scenario())
+
+def test_delivery_stats(make_storage):
+    async def scenario():
+        db = make_storage()
+        hour = int(time.time() // 3600)
+        await db._upsert_users([(1, 100)])
+        await db._save_delivery_stats(
+            [("FILE_a", 3, sketch_of([1, 2])), ("FILE_b", 1, sketch_of([1]))],
+            [(hour, 4, 2, 1)],
+            [("FILE_a", 1)]
+        )
+        await db._save_delivery_stats([("FILE_a", 2, sketch_of([3]))], [(hour, 2, 0, 0)], [])
+
+        top = await db._get_top_files(10)
+        assert [(stat_key, deliveries) for stat_key, deliveries, _ in top] == [("FILE_a", 5), ("FILE_b", 1)]
+        assert HyperLogLog(registers=top[0][2]).count() == 3
+        assert await db._get_hourly_stats(hour - 1) == [(hour, 6, 2, 1)]
+        assert await db._count_users(("downloaded", "FILE_a")) == 1
+    run(scenario())
+
+def test_concurrent_delivery_stats_merge_every_sketch(make_storage):
+    async def scenario():
+        first, second = make_storage(), make_storage()
+        await asyncio.gather(
+            first._save_delivery_stats([("FILE_a", 100, sketch_of(range(100)))], [], []),
+            second._save_delivery_stats([("FILE_a", 100, sketch_of(range(100, 200)))], [], [])
+        )
+        (stat_key, deliveries, registers), = await first._get_top_files(1)
+        assert deliveries == 200
+        # Both processes' recipients survive the merge
+        assert 190 <= HyperLogLog(registers=registers).count() <= 210
+    run(scenario())
+
+def test_close_flushes_buffered_users(make_storage):
+    async def scenario():
+        db = make_storage()
+        await db.add_user(5)
+        await db.close()
+        return await make_storage()._count_users(None)
+    assert run(scenario()) == 1
+
+def test_add_user_skips_recently_seen_users(make_storage):
+    async def scenario():
+        db = make_storage()
+        db._known_users.maxsize = 3
+        await db.add_user(1)
+        await db.flush_users()
+        await db.add_user(1)
+        assert not db._pending_users
+        # Deactivation forgets them, so their next message reactivates them
+        await db.deactivate_users([(1, "blocked")])
+        await db.add_user(1)
+        assert db._pending_users == {1: db._known_users.peek(1)}
+        for user_id in range(2, 10):
+            await db.add_user(user_id)
+        assert len(db._known_users) == 3
+        await db.flush_users()
+        assert await db._count_users(None) == 9
+    run(scenario())
+
+def test_sweep_state(make_storage):
+    async def scenario():
+        db = make_storage()
+        assert await db._get_sweep_state() is None
+        await db._add_files([(f"key{i:03d}", i) for i in range(25)])
+        chunks = db.iter_files(chunk_size=10)
+        first, cursor = await chunks.__anext__()
+        await chunks.aclose()
+        state = {"cursor": cursor, "started_at": 100, "finished_at": None, "checked": len(first), "dead": 0}
+        await db._save_sweep_state(state)
+        # The cursor is opaque to callers and comes back as a string
+        state = await db._get_sweep_state()
+        assert state == {"cursor": str(cursor), "started_at": 100, "finished_at": None, "checked": len(first), "dead": 0}
+
+        # A restart continues after the stored cursor
+        rest = [entry async for chunk, _ in db.iter_files(chunk_size=10, cursor=state["cursor"]) for entry in chunk]
+        assert sorted(list(first) + rest) == [(f"key{i:03d}", i) for i in range(25)]
+
+        state.update(cursor=None, finished_at=200)
+        await db._save_sweep_state(state)
+        assert await db._get_sweep_state() == state
+    run(scenario())
+
+def test_leases(make_storage):
+    async def scenario():
+        first, second = make_storage(), make_storage()
+        assert await first._acquire_lease("job", "a", 60)
+        assert not await second._acquire_lease("job", "b", 60)
+        # The holder renews it; someone else releasing it is a no-op
+        assert await first._acquire_lease("job", "a", 60)
+        await second._release_lease("job", "b")
+        assert not await second._acquire_lease("job", "b", 60)
+        await first._release_lease("job", "a")
+        assert await second._acquire_lease("job", "b", 0.01)
+        # A lease that isn't renewed lapses
+        await asyncio.sleep(0.02)
+        assert await first._acquire_lease("job", "a", 60)
+    run(scenario())
@@ -0,0 +1,117 @@
+import logging
+import time
+from pyrogram import Client
+from storage import get_storage
+from config import ANALYTICS_FLUSH_INTERVAL
+from utils.hyperloglog import HyperLogLog
+from utils.flusher import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+db = get_storage()
+
+class Analytics:
+    """Delivery counters aggregated in memory and flushed to storage in batches
+
+    Recording a delivery only touches in-memory counters; every
+    flush_interval seconds the accumulated counts are written in one
+    transaction. Links are identified by their start parameter (FILE_... or
+    BUNDLE_...), and unique recipients are estimated with a HyperLogLog.
+    """
+
+    def __init__(self, flush_interval=ANALYTICS_FLUSH_INTERVAL):
+        self._deliveries = {}  # stat_key -> deliveries since the last flush
+        self._uniques = {}     # stat_key -> HyperLogLog of recipients
+        self._hours = {}       # hour -> [deliveries, gate_shown, gate_passed]
+        self._downloads = set()  # (stat_key, user_id) for broadcast segments
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
+
+    def record_delivery(self, stat_key, user_id, after_gate=False):
+        """Count a link delivered to user_id; after_gate marks a delivery via 'Try Again'"""
+        self._deliveries[stat_key] = self._deliveries.get(stat_key, 0) + 1
+        sketch = self._uniques.get(stat_key)
+        if sketch is None:
+            sketch = self._uniques[stat_key] = HyperLogLog()
+        sketch.add(user_id)
+        self._downloads.add((stat_key, user_id))
+        counts = self._hour_counts()
+        counts[0] += 1
+        if after_gate:
+            counts[2] += 1
+        self._flusher.start()
+
+    def record_gate_shown(self):
+        """Count a user being sent to the force join channels instead of the file"""
+        self._hour_counts()[1] += 1
+        self._flusher.start()
+
+    def _hour_counts(self):
+        hour = int(time.time() // 3600)
+        counts = self._hours.get(hour)
+        if counts is None:
+            counts = self._hours[hour] = [0, 0, 0]
+        return counts
+
+    async def flush(self):
+        """Write the counts gathered since the last flush in one batch"""
+        if not self._deliveries and not self._hours:
+            return True
+        deliveries, self._deliveries = self._deliveries, {}
+        uniques, self._uniques = self._uniques, {}
+        hours, self._hours = self._hours, {}
+        downloads, self._downloads = self._downloads, set()
+
+        files = [
+            (stat_key, count, bytes(uniques[stat_key].registers))
+            for stat_key, count in deliveries.items()
+        ]
+        hour_rows = [(hour, *counts) for hour, counts in hours.items()]
+        if await db.save_delivery_stats(files, hour_rows, list(downloads)):
+            return True
+
+        # Keep the counts so the next flush retries them
+        for stat_key, count in deliveries.items():
+            self._deliveries[stat_key] = self._deliveries.get(stat_key, 0) + count
+            sketch = self._uniques.setdefault(stat_key, HyperLogLog())
+            sketch.merge(uniques[stat_key].registers)
+        for hour, counts in hours.items():
+            current = self._hours.setdefault(hour, [0, 0, 0])
+            for i, count in enumerate(counts):
+                current[i] += count
+        self._downloads |= downloads
+        return False
+
+    async def close(self):
+        """Stop the flush loop and write whatever is still in memory"""
+        return await self._flusher.close()
+
+    async def send_report(self, client: Client, message, top=10, hours=24):
+        """Reply with the most delivered links, deliveries per hour and gate conversion"""
+        await self.flush()
+        top_files = await db.get_top_files(top)
+        hourly = await db.get_hourly_stats(int(time.time() // 3600) - hours + 1)
+
+        report = "📊 **Download Stats**\n\n**Top links** (deliveries / unique users):\n"
+        if top_files:
+            for i, (stat_key, deliveries, uniques) in enumerate(top_files, start=1):
+                users = HyperLogLog(registers=uniques).count()
+                report += f"{i}. `{stat_key}` — {deliveries} / ~{users}\n"
+        else:
+            report += "No deliveries yet.\n"
+
+        total = sum(row[1] for row in hourly)
+        gate_shown = sum(row[2] for row in hourly)
+        gate_passed = sum(row[3] for row in hourly)
+        report += f"\n**Last {hours} hours:** {total} deliveries\n"
+        for hour, deliveries, _, _ in hourly:
+            if deliveries:
+                report += f"{time.strftime('%H:00', time.gmtime(hour * 3600))} UTC — {deliveries}\n"
+
+        conversion = f" ({gate_passed / gate_shown * 100:.1f}%)" if gate_shown else ""
+        report += (
+            f"\n**Force join gate:** shown {gate_shown} times, "
+            f"{gate_passed} files delivered after 'Try Again'{conversion}"
+        )
+        await message.reply_text(report)
+
+# Shared by the delivery paths and the /stats command
+analytics = Analytics()
@@ -1,20 +1,65 @@
+import asyncio
 import time
 import logging
 from pyrogram import Client
-from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated
-from database import Database
-from config import ADMIN_ID
+from pyrogram.errors import FloodWait, UserIsBlocked, InputUserDeactivated, MessageNotModified
+from storage import get_storage, BROADCAST_STAT_FIELDS
+from config import (
+    ADMIN_ID, BROADCAST_RATE, BROADCAST_WORKERS, BROADCAST_MAX_RETRIES,
+    BROADCAST_PROGRESS_INTERVAL, BROADCAST_CHECKPOINT_EVERY, LEASE_TTL
+)
+from utils.rate_limiter import TokenBucket
+from utils.metrics import broadcast_messages
+from utils.scheduler import scheduler, BROADCAST, PROGRESS
 
 logger = logging.getLogger(__name__)
-db = Database()
+db = get_storage()
+
+# Held by the process sending the active broadcast job
+BROADCAST_LEASE = "broadcast"
+
+BROADCAST_USAGE = (
+    "Usage: /broadcast [segment]\n\n"
+    "• /broadcast — all users\n"
+    "• /broadcast active 7 — users active in the last 7 days (any number of days)\n"
+    "• /broadcast downloaded <link or FILE_/BUNDLE_ key> — users who received that file"
+)
+
+def parse_segment_args(args):
+    """Turn the words after /broadcast into a storage segment; raises ValueError if they don't parse"""
+    if not args:
+        return None
+    if args[0] == "active" and len(args) == 2 and args[1].isdigit() and int(args[1]) > 0:
+        return f"active:{int(args[1])}"
+    if args[0] == "downloaded" and len(args) == 2:
+        # Accept the share link itself as well as its start parameter
+        start_param = args[1].split("start=", 1)[-1]
+        if start_param.startswith(("FILE_", "BUNDLE_")):
+            return f"downloaded:{start_param}"
+    raise ValueError(f"Unknown segment: {' '.join(args)}")
+
+def describe_segment(segment):
+    """Human-readable audience of a broadcast"""
+    if segment is None:
+        return "all users"
+    kind, _, value = segment.partition(":")
+    if kind == "active":
+        return f"users active in the last {value} days"
+    return f"users who downloaded {value}"
 
 class Broadcast:
     def __init__(self):
         self.is_broadcasting = False
         self.broadcast_message = None
-        self.rate_limit = 10  # messages per minute
-        self.last_broadcast_time = 0
+        # Caps broadcast sends below the scheduler's global rate, leaving
+        # room for interactive traffic
+        self.bucket = TokenBucket(BROADCAST_RATE)
         self.progress_msg_id = None
+        self.progress_text = None  # what the progress message currently says
+        self.task = None
+        self.job = None
+        self.segment = None  # audience of the broadcast being set up
+        self.stop_reason = None  # "paused", "cancelled", "shutdown" or "lease lost" once requested
     
     async def start_broadcast(self, client: Client, message):
         """Start the broadcast process"""
@@ -22,11 +67,27 @@ class Broadcast:
             await message.reply_text("A broadcast is already in progress.")
             return
         
+        job = await db.get_active_broadcast()
+        if job is not None:
+            await message.reply_text(
+                f"Broadcast #{job['id']} is {job['status']}.\n\n"
+                "Use /resumebroadcast or /cancelbroadcast first."
+            )
+            return
+        
+        # message.command is None when started from the admin panel button
+        try:
+            segment = parse_segment_args((message.command or [])[1:])
+        except ValueError:
+            await message.reply_text(BROADCAST_USAGE)
+            return
+        
         self.is_broadcasting = True
         self.broadcast_message = None
+        self.segment = segment
         
         await message.reply_text(
-            "Please send the message you want to broadcast.\n\n"
+            f"Please send the message you want to broadcast to {describe_segment(segment)}.\n\n"
             "You can send any type of message: text, photo, video, document, etc."
         )
     
@@ -36,161 +97,422 @@ class Broadcast:
             return False
         
         self.broadcast_message = message
+        total = await db.count_users(self.segment)
+        self.job = await db.create_broadcast(message.chat.id, message.id, total, self.segment)
+        if self.job is None:
+            self.is_broadcasting = False
+            self.broadcast_message = None
+            await message.reply_text("❌ Could not start the broadcast. Please try again.")
+            return True
+        if not await db.acquire_lease(BROADCAST_LEASE):
+            await db.set_broadcast_status(self.job["id"], "cancelled")
+            self.is_broadcasting = False
+            self.broadcast_message = None
+            await message.reply_text("❌ Another bot process is sending a broadcast. Please try again later.")
+            return True
+        
         await message.reply_text(
-            "Broadcast message received. Starting broadcast to all users...\n\n"
-            "This may take some time depending on the number of users."
+            f"Broadcast #{self.job['id']} received. Starting broadcast to "
+            f"{describe_segment(self.segment)} ({total})...\n\n"
+            "This may take some time depending on the number of users.\n"
+            "Use /pausebroadcast or /cancelbroadcast to stop it."
         )
         
-        await self.send_broadcast(client)
+        self.run(client)
         return True
     
-    async def send_broadcast(self, client: Client):
-        """Send the broadcast message to all users"""
-        users = db.get_all_users()
-        total_users = len(users)
-        successful = 0
-        blocked = 0
-        deactivated = 0
-        flood_wait = 0
-        other_errors = 0
-        
-        start_time = time.time()
-        
-        for i, user_id in enumerate(users):
-            if not self.is_broadcasting:
-                break
-                
+    def run(self, client: Client):
+        """Run the current job in the background so the bot keeps serving file requests"""
+        self.is_broadcasting = True
+        self.stop_reason = None
+        self.progress_msg_id = None
+        self.progress_text = None
+        self.task = asyncio.create_task(self._send_leased(client))
+    
+    async def _send_leased(self, client: Client):
+        """Send the current job, then release its lease (once its status is stored) for other processes"""
+        try:
+            await self.send_broadcast(client)
+        finally:
+            await db.release_lease(BROADCAST_LEASE)
+    
+    async def load_job(self, client: Client, job):
+        """Make job the current broadcast, fetching its message again; False if it is gone"""
+        try:
+            message = await scheduler.call(BROADCAST, client.get_messages, job["from_chat_id"], job["message_id"])
+        except Exception as e:
+            logger.error(f"Error loading message of broadcast {job['id']}: {str(e)}")
+            message = None
+        if message is None or message.empty:
+            await db.set_broadcast_status(job["id"], "cancelled")
+            return False
+        self.job = job
+        self.broadcast_message = message
+        return True
+    
+    async def resume_loop(self, client: Client):
+        """Resume interrupted broadcasts now and whenever their process stops without finishing them"""
+        while True:
+            await self.resume_pending(client)
+            await asyncio.sleep(LEASE_TTL)
+    
+    async def resume_pending(self, client: Client):
+        """Resume a broadcast left running by a process that stopped, unless another process is sending it"""
+        if self.is_broadcasting or (self.task is not None and not self.task.done()):
+            return
+        job = await db.get_active_broadcast()
+        if job is None or job["status"] != "running" or not await db.acquire_lease(BROADCAST_LEASE):
+            return
+        # Its sender may have finished it just before releasing the lease
+        job = await db.get_broadcast(job["id"])
+        if job is None or job["status"] != "running":
+            await db.release_lease(BROADCAST_LEASE)
+            return
+        if not await self.load_job(client, job):
+            await db.release_lease(BROADCAST_LEASE)
+            logger.warning(f"Broadcast {job['id']} message is gone; cancelled it")
+            return
+        logger.info(f"Resuming broadcast {job['id']} after user {job['cursor']}")
+        self.run(client)
+        try:
+            await scheduler.call(
+                PROGRESS,
+                client.send_message,
+                ADMIN_ID,
+                f"🔄 Resuming broadcast #{job['id']} ({job['processed']}/{job['total']} done).",
+                per_chat=ADMIN_ID
+            )
+        except Exception as e:
+            logger.error(f"Error notifying admin about resumed broadcast: {str(e)}")
+    
+    async def pause(self, client: Client, message):
+        """Pause the running broadcast at the next checkpoint"""
+        if self.task is None or self.task.done():
+            job = await db.get_active_broadcast()
+            if job is None or job["status"] != "running":
+                await message.reply_text("No broadcast is running.")
+                return
+            # Sent by another process, which stops at its next checkpoint
+            await db.set_broadcast_status(job["id"], "paused")
+            await message.reply_text(f"⏸ Pausing broadcast #{job['id']}...")
+            return
+        self.stop_reason = "paused"
+        await message.reply_text("⏸ Pausing broadcast...")
+    
+    async def resume(self, client: Client, message):
+        """Resume a paused broadcast, or one whose process stopped without finishing it"""
+        if self.task is not None and not self.task.done():
+            await message.reply_text("A broadcast is already in progress.")
+            return
+        job = await db.get_active_broadcast()
+        if job is None:
+            await message.reply_text("No paused broadcast.")
+            return
+        if not await db.acquire_lease(BROADCAST_LEASE):
+            await message.reply_text(
+                f"Broadcast #{job['id']} is still being sent by another bot process; try again shortly."
+            )
+            return
+        job = await db.get_broadcast(job["id"])
+        if job is None or job["status"] not in ("paused", "running"):
+            await db.release_lease(BROADCAST_LEASE)
+            await message.reply_text("No paused broadcast.")
+            return
+        if not await self.load_job(client, job):
+            await db.release_lease(BROADCAST_LEASE)
+            await message.reply_text("❌ The broadcast message no longer exists; broadcast cancelled.")
+            return
+        await db.set_broadcast_status(job["id"], "running")
+        self.run(client)
+        await message.reply_text(f"▶️ Resuming broadcast #{job['id']}.")
+    
+    async def checkpoint_for_shutdown(self, timeout):
+        """Stop the running broadcast at a checkpoint so the next start resumes it
+
+        Returns "idle" if none was running, "checkpointed", or "abandoned" if
+        it didn't stop within timeout; it then resumes from its previous
+        checkpoint, and users after that may get the message twice.
+        """
+        if self.task is None or self.task.done():
+            # In case shutdown interrupted resume_pending after it took the lease
+            await db.release_lease(BROADCAST_LEASE)
+            return "idle"
+        if self.stop_reason is None:
+            self.stop_reason = "shutdown"
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+            return "checkpointed"
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            return "abandoned"
+    
+    async def cancel(self, client: Client, message):
+        """Cancel the running, paused or not yet started broadcast"""
+        if self.task is not None and not self.task.done():
+            self.stop_reason = "cancelled"
+            await message.reply_text("⏹ Cancelling broadcast...")
+            return
+        job = await db.get_active_broadcast()
+        if job is not None:
+            await db.set_broadcast_status(job["id"], "cancelled")
+            await message.reply_text(f"⏹ Broadcast #{job['id']} cancelled.")
+        elif self.is_broadcasting:
+            await message.reply_text("⏹ Broadcast cancelled.")
+        else:
+            await message.reply_text("No broadcast to cancel.")
+        self.is_broadcasting = False
+        self.broadcast_message = None
+    
+    async def send_to_user(self, client: Client, user_id):
+        """Send the broadcast message to a single user based on its type"""
+        message = self.broadcast_message
+        if message.text:
+            await client.send_message(
+                user_id,
+                message.text,
+                reply_markup=message.reply_markup
+            )
+        elif message.photo:
+            await client.send_photo(
+                user_id,
+                message.photo.file_id,
+                caption=message.caption,
+                reply_markup=message.reply_markup
+            )
+        elif message.video:
+            await client.send_video(
+                user_id,
+                message.video.file_id,
+                caption=message.caption,
+                reply_markup=message.reply_markup
+            )
+        elif message.document:
+            await client.send_document(
+                user_id,
+                message.document.file_id,
+                caption=message.caption,
+                reply_markup=message.reply_markup
+            )
+        elif message.audio:
+            await client.send_audio(
+                user_id,
+                message.audio.file_id,
+                caption=message.caption,
+                reply_markup=message.reply_markup
+            )
+        else:
+            # Stickers, animations, voice notes, polls, ...
+            await client.copy_message(
+                user_id,
+                message.chat.id,
+                message.id,
+                reply_markup=message.reply_markup
+            )
+    
+    async def deliver(self, client: Client, user_id, stats, dead_users):
+        """Send to one user, retrying after FloodWait, and record the outcome in stats
+
+        Users that can no longer be reached are appended to dead_users as
+        (user_id, reason) so they can be deactivated in bulk.
+        """
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
             try:
-                # Rate limiting: 10 messages per minute
-                elapsed = time.time() - start_time
-                if i > 0:
-                    # Calculate time since last message
-                    time_since_last = time.time() - self.last_broadcast_time
-                    if time_since_last < 6:  # Less than 6 seconds since last message
-                        time.sleep(6 - time_since_last)
-                
-                # Send the message based on its type
-                if self.broadcast_message.text:
-                    await client.send_message(
-                        user_id,
-                        self.broadcast_message.text,
-                        reply_markup=self.broadcast_message.reply_markup
-                    )
-                elif self.broadcast_message.photo:
-                    await client.send_photo(
-                        user_id,
-                        self.broadcast_message.photo.file_id,
-                        caption=self.broadcast_message.caption,
-                        reply_markup=self.broadcast_message.reply_markup
-                    )
-                elif self.broadcast_message.video:
-                    await client.send_video(
-                        user_id,
-                        self.broadcast_message.video.file_id,
-                        caption=self.broadcast_message.caption,
-                        reply_markup=self.broadcast_message.reply_markup
-                    )
-                elif self.broadcast_message.document:
-                    await client.send_document(
-                        user_id,
-                        self.broadcast_message.document.file_id,
-                        caption=self.broadcast_message.caption,
-                        reply_markup=self.broadcast_message.reply_markup
-                    )
-                elif self.broadcast_message.audio:
-                    await client.send_audio(
-                        user_id,
-                        self.broadcast_message.audio.file_id,
-                        caption=self.broadcast_message.caption,
-                        reply_markup=self.broadcast_message.reply_markup
-                    )
-                
-                successful += 1
-                self.last_broadcast_time = time.time()
-                
-                # Update progress every 10 users
-                if (i + 1) % 10 == 0 or i == total_users - 1:
-                    await self.update_progress(client, i + 1, total_users, successful, blocked, deactivated, flood_wait, other_errors)
+                # Retries are handled here so they are counted in stats
+                await scheduler.call(
+                    BROADCAST, self.send_to_user, client, user_id, per_chat=user_id, retries=0
+                )
+                stats["successful"] += 1
+                broadcast_messages.labels("successful").inc()
+                return
             
             except FloodWait as e:
-                flood_wait += 1
-                logger.warning(f"FloodWait error for user {user_id}: waiting {e.value} seconds")
-                time.sleep(e.value)
-                # Try sending again after waiting
-                try:
-                    if self.broadcast_message.text:
-                        await client.send_message(
-                            user_id,
-                            self.broadcast_message.text,
-                            reply_markup=self.broadcast_message.reply_markup
-                        )
-                    successful += 1
-                except Exception:
-                    other_errors += 1
+                # The scheduler has already paused the broadcast class
+                stats["flood_wait"] += 1
+                broadcast_messages.labels("flood_wait").inc()
+                logger.warning(f"FloodWait error for user {user_id}: broadcast paused for {e.value} seconds")
             
             except UserIsBlocked:
-                blocked += 1
-                db.remove_user(user_id)  # Remove blocked users
+                stats["blocked"] += 1
+                broadcast_messages.labels("blocked").inc()
+                dead_users.append((user_id, "blocked"))
+                return
             
             except InputUserDeactivated:
-                deactivated += 1
-                db.remove_user(user_id)  # Remove deactivated users
+                stats["deactivated"] += 1
+                broadcast_messages.labels("deactivated").inc()
+                dead_users.append((user_id, "deactivated"))
+                return
             
             except Exception as e:
-                other_errors += 1
+                stats["other_errors"] += 1
+                broadcast_messages.labels("other_errors").inc()
                 logger.error(f"Error sending broadcast to {user_id}: {str(e)}")
+                return
         
-        self.is_broadcasting = False
+        stats["other_errors"] += 1
+        broadcast_messages.labels("other_errors").inc()
+        logger.error(f"Giving up on broadcast to {user_id} after {BROADCAST_MAX_RETRIES} retries")
+    
+    async def send_broadcast(self, client: Client):
+        """Send the broadcast message to all users, checkpointing as it goes"""
+        job = self.job
+        total = job["total"]
+        stats = {field: job[field] for field in BROADCAST_STAT_FIELDS}
+        cursor = job["cursor"]
+        dead_users = []
+        queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
         
-        # Send final report
-        await self.send_report(client, total_users, successful, blocked, deactivated, flood_wait, other_errors)
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    await self.deliver(client, user_id, stats, dead_users)
+                finally:
+                    stats["processed"] += 1
+                    queue.task_done()
+        
+        async def report_progress():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await self.update_progress(client, total, stats)
+        
+        start_time = time.time()
+        workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+        progress = asyncio.create_task(report_progress())
+        
+        try:
+            # Users in the job's segment are streamed in keyset order, one
+            # checkpoint-sized chunk at a time
+            async for chunk in db.iter_users(
+                after=cursor, chunk_size=BROADCAST_CHECKPOINT_EVERY, segment=job["segment"]
+            ):
+                last_queued = cursor
+                for user_id in chunk:
+                    if self.stop_reason is not None:
+                        break
+                    await queue.put(user_id)
+                    last_queued = user_id
+                # Everyone up to last_queued has been handled once the queue drains
+                await queue.join()
+                cursor = last_queued
+                # Blocked/deactivated users are marked inactive once per chunk
+                await db.deactivate_users(dead_users)
+                dead_users.clear()
+                if not await db.acquire_lease(BROADCAST_LEASE):
+                    # Another process took the job over from the previous
+                    # checkpoint; this chunk's users may get it twice
+                    self.stop_reason = "lease lost"
+                    break
+                await db.save_broadcast_progress(job["id"], cursor, stats)
+                stored = await db.get_broadcast(job["id"])
+                if self.stop_reason is None and stored is not None and stored["status"] in ("paused", "cancelled"):
+                    # Paused or cancelled from another process
+                    self.stop_reason = stored["status"]
+                if self.stop_reason is not None:
+                    break
+        except Exception as e:
+            # Leave the job "running" so it is picked up again on restart
+            logger.error(f"Broadcast {job['id']} stopped unexpectedly: {str(e)}")
+            return
+        finally:
+            progress.cancel()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(progress, *workers, return_exceptions=True)
+            self.is_broadcasting = False
+            self.broadcast_message = None
+        
+        if self.stop_reason == "shutdown":
+            # Left "running", so the next start resumes after the checkpoint
+            logger.info(f"Broadcast {job['id']} checkpointed after user {cursor} for shutdown")
+            return
+        if self.stop_reason == "lease lost":
+            logger.warning(f"Broadcast {job['id']} was taken over by another process; stopped sending it")
+            return
+        
+        status = self.stop_reason or "completed"
+        await db.set_broadcast_status(job["id"], status)
+        logger.info(f"Broadcast {job['id']} {status}: {stats['processed']} users in {time.time() - start_time:.1f}s")
+        await self.update_progress(client, total, stats)
+        
+        if status == "completed":
+            # Send final report
+            await self.send_report(client, total, stats)
+        else:
+            try:
+                await scheduler.call(
+                    PROGRESS,
+                    client.send_message,
+                    ADMIN_ID,
+                    f"Broadcast #{job['id']} {status} after {stats['processed']}/{total} users."
+                    + ("\nUse /resumebroadcast to continue." if status == "paused" else ""),
+                    per_chat=ADMIN_ID
+                )
+            except Exception as e:
+                logger.error(f"Error notifying admin about broadcast: {str(e)}")
     
-    async def update_progress(self, client: Client, current, total, successful, blocked, deactivated, flood_wait, other_errors):
+    async def update_progress(self, client: Client, total, stats):
         """Update broadcast progress"""
-        progress = (current / total) * 100
+        current = stats["processed"]
+        progress = min(current / total, 1) * 100 if total else 100.0
         report = (
             f"📊 Broadcast Progress: {progress:.1f}%\n"
             f"📤 Total: {current}/{total}\n"
-            f"✅ Successful: {successful}\n"
-            f"❌ Blocked: {blocked}\n"
-            f"👻 Deactivated: {deactivated}\n"
-            f"⏳ FloodWait: {flood_wait}\n"
-            f"⚠️ Errors: {other_errors}"
+            f"✅ Successful: {stats['successful']}\n"
+            f"❌ Blocked: {stats['blocked']}\n"
+            f"👻 Deactivated: {stats['deactivated']}\n"
+            f"⏳ FloodWait: {stats['flood_wait']}\n"
+            f"⚠️ Errors: {stats['other_errors']}"
         )
+        if self.progress_msg_id and report == self.progress_text:
+            # Nothing changed (e.g. while waiting out a FloodWait)
+            return
         
         try:
             if self.progress_msg_id:
                 # Try to edit the last progress message
-                await client.edit_message_text(
+                await scheduler.call(
+                    PROGRESS,
+                    client.edit_message_text,
                     ADMIN_ID,
                     self.progress_msg_id,
-                    report
+                    report,
+                    per_chat=ADMIN_ID
                 )
             else:
-                msg = await client.send_message(ADMIN_ID, report)
+                msg = await scheduler.call(PROGRESS, client.send_message, ADMIN_ID, report, per_chat=ADMIN_ID)
                 self.progress_msg_id = msg.id
+            self.progress_text = report
+        except MessageNotModified:
+            # The message already shows this report
+            self.progress_text = report
         except Exception as e:
             logger.error(f"Error updating broadcast progress: {str(e)}")
             try:
-                msg = await client.send_message(ADMIN_ID, report)
+                msg = await scheduler.call(PROGRESS, client.send_message, ADMIN_ID, report, per_chat=ADMIN_ID)
                 self.progress_msg_id = msg.id
+                self.progress_text = report
             except Exception as e2:
                 logger.error(f"Error sending new progress message: {str(e2)}")
     
-    async def send_report(self, client: Client, total, successful, blocked, deactivated, flood_wait, other_errors):
+    async def send_report(self, client: Client, total, stats):
         """Send final broadcast report"""
+        success_rate = stats["successful"] / total * 100 if total else 0.0
         report = (
             "✅ Broadcast Completed!\n\n"
+            f"🎯 Audience: {describe_segment(self.job['segment'])}\n"
             f"📬 Total Users: {total}\n"
-            f"✅ Delivered: {successful}\n"
-            f"❌ Blocked: {blocked}\n"
-            f"👻 Deactivated: {deactivated}\n"
-            f"⏳ FloodWait: {flood_wait}\n"
-            f"⚠️ Errors: {other_errors}\n\n"
-            f"📊 Success Rate: {successful/total*100:.1f}%"
+            f"✅ Delivered: {stats['successful']}\n"
+            f"❌ Blocked: {stats['blocked']}\n"
+            f"👻 Deactivated: {stats['deactivated']}\n"
+            f"⏳ FloodWait: {stats['flood_wait']}\n"
+            f"⚠️ Errors: {stats['other_errors']}\n\n"
+            f"📊 Success Rate: {success_rate:.1f}%"
         )
         
         try:
-            await client.send_message(ADMIN_ID, report)
+            await scheduler.call(PROGRESS, client.send_message, ADMIN_ID, report, per_chat=ADMIN_ID)
         except Exception as e:
             logger.error(f"Error sending broadcast report: {str(e)}")
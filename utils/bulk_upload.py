@@ -0,0 +1,155 @@
+import logging
+from pyrogram import Client
+from storage import get_storage
+from config import STORAGE_CHANNEL_ID, BOT_USERNAME
+from utils.scheduler import scheduler, INTERACTIVE
+from utils.helpers import (
+    generate_unique_key, create_deep_link, create_bundle_link, copy_messages, get_file_name
+)
+
+logger = logging.getLogger(__name__)
+db = get_storage()
+
+# Telegram's limit on the length of a single text message
+MAX_MESSAGE_LENGTH = 4096
+
+class BulkUpload:
+    def __init__(self):
+        self.is_collecting = False
+        self.as_bundle = False
+        self.messages = []
+
+    async def start(self, client: Client, message, as_bundle=False):
+        """Start collecting files for a bulk upload, or for a single bundle link"""
+        if self.is_collecting:
+            await message.reply_text(
+                f"A bulk upload is already in progress ({len(self.messages)} files so far).\n\n"
+                "Send /done to finish it or /cancelbulk to discard it."
+            )
+            return
+
+        self.is_collecting = True
+        self.as_bundle = as_bundle
+        self.messages = []
+        kind = "Bundle" if as_bundle else "Bulk"
+        result = "one link for all of them" if as_bundle else "the links"
+        await message.reply_text(
+            f"📦 {kind} upload started.\n\n"
+            "Send or forward all the files and albums you want to upload, "
+            f"then send /done to get {result}. Send /cancelbulk to discard them."
+        )
+
+    async def add_message(self, client: Client, message):
+        """Collect a file for the current bulk upload; False if no bulk upload is running"""
+        if not self.is_collecting:
+            return False
+        if not (message.photo or message.video or message.document or message.audio):
+            return False
+
+        self.messages.append(message)
+        return True
+
+    async def cancel(self, client: Client, message):
+        """Discard the current bulk upload"""
+        if not self.is_collecting:
+            await message.reply_text("No bulk upload in progress.")
+            return
+
+        count = len(self.messages)
+        self.is_collecting = False
+        self.messages = []
+        await message.reply_text(f"🗑 Bulk upload cancelled, {count} files discarded.")
+
+    async def finish(self, client: Client, message):
+        """Copy the collected files to storage in batches and reply with every link"""
+        if not self.is_collecting:
+            await message.reply_text("No bulk upload in progress.")
+            return
+
+        # Album parts can arrive out of order; keep the order they were sent in
+        messages = sorted(self.messages, key=lambda m: m.id)
+        self.is_collecting = False
+        self.messages = []
+
+        if not messages:
+            await message.reply_text("No files were sent, nothing to upload.")
+            return
+
+        # Filled batch by batch, so a FloodWait retry resumes where it stopped
+        copied = []
+        try:
+            stored_ids = await scheduler.call(
+                INTERACTIVE,
+                copy_messages,
+                client,
+                STORAGE_CHANNEL_ID,
+                message.chat.id,
+                [m.id for m in messages],
+                copied,
+                per_chat=STORAGE_CHANNEL_ID
+            )
+        except Exception as e:
+            logger.error(f"Error copying bulk upload to storage: {str(e)}")
+            if not copied:
+                await message.reply_text(f"❌ Error uploading files: {str(e)}")
+                return
+            # Link the batches that did reach storage rather than orphaning them
+            stored_ids = copied + [None] * (len(messages) - len(copied))
+
+        if self.as_bundle:
+            await self.finish_bundle(message, messages, stored_ids)
+            return
+
+        entries = []
+        lines = []
+        failed = 0
+        for i, (original, stored_id) in enumerate(zip(messages, stored_ids), start=1):
+            if stored_id is None:
+                failed += 1
+                lines.append(f"{i}. {get_file_name(original)}\n❌ Not copied to storage")
+                continue
+            unique_key = generate_unique_key()
+            entries.append((unique_key, stored_id))
+            lines.append(f"{i}. {get_file_name(original)}\n`{create_deep_link(BOT_USERNAME, unique_key)}`")
+
+        if not await db.add_files(entries):
+            await message.reply_text("❌ Error saving the uploaded files. Please try again.")
+            return
+
+        header = f"✅ Uploaded {len(entries)} of {len(messages)} files!\n\n"
+        if failed:
+            header = f"⚠️ Uploaded {len(entries)} of {len(messages)} files, {failed} failed.\n\n"
+        await self.send_summary(message, header, lines)
+
+    async def finish_bundle(self, message, messages, stored_ids):
+        """Store the copied files under one bundle key and reply with its link"""
+        bundle_ids = [stored_id for stored_id in stored_ids if stored_id is not None]
+        if not bundle_ids:
+            await message.reply_text("❌ None of the files could be copied to storage.")
+            return
+
+        unique_key = generate_unique_key()
+        if not await db.add_bundle(unique_key, bundle_ids):
+            await message.reply_text("❌ Error saving the bundle. Please try again.")
+            return
+
+        header = f"✅ Bundle of {len(bundle_ids)} files created!\n\n"
+        if len(bundle_ids) < len(messages):
+            header = f"⚠️ Bundle created with {len(bundle_ids)} of {len(messages)} files.\n\n"
+        lines = [f"🔗 Deep Link: `{create_bundle_link(BOT_USERNAME, unique_key)}`"]
+        lines.extend(
+            f"{i}. {get_file_name(original)}" + (" ❌ Not copied" if stored_id is None else "")
+            for i, (original, stored_id) in enumerate(zip(messages, stored_ids), start=1)
+        )
+        await self.send_summary(message, header, lines)
+
+    async def send_summary(self, message, header, lines):
+        """Reply with the summary, split only where it exceeds Telegram's message length"""
+        text = header
+        for line in lines:
+            if len(text) + len(line) + 2 > MAX_MESSAGE_LENGTH:
+                await message.reply_text(text, disable_web_page_preview=True)
+                text = ""
+            text += line + "\n\n"
+        if text:
+            await message.reply_text(text, disable_web_page_preview=True)
@@ -0,0 +1,114 @@
+import logging
+from pyrogram import Client
+from pyrogram.types import Message
+from storage import get_storage
+from config import FORCE_CHANNELS, STORAGE_CHANNEL_ID, API_MAX_RETRIES
+from utils.force_join import is_user_joined
+from utils.scheduler import scheduler, INTERACTIVE
+from utils.analytics import analytics
+from utils.delivery_queue import delivery_queue, QUEUED, FULL
+from utils.helpers import (
+    get_join_channels_keyboard, copy_messages,
+    get_unique_key_from_start_param, get_bundle_key_from_start_param, is_valid_key
+)
+from utils.metrics import rejected_lookups
+
+logger = logging.getLogger(__name__)
+db = get_storage()
+
+async def get_deep_link_message_ids(start_param):
+    """Resolve a FILE_ or BUNDLE_ start parameter to its storage message_ids, or None"""
+    unique_key = get_unique_key_from_start_param(start_param)
+    if unique_key is not None:
+        if not is_valid_key(unique_key):
+            rejected_lookups.labels("checksum").inc()
+            return None
+        message_id = await db.get_file_message_id(unique_key)
+        return [message_id] if message_id else None
+
+    bundle_key = get_bundle_key_from_start_param(start_param)
+    if bundle_key is not None:
+        if not is_valid_key(bundle_key):
+            rejected_lookups.labels("checksum").inc()
+            return None
+        return await db.get_bundle_message_ids(bundle_key)
+
+    return None
+
+async def send_stored_messages(client: Client, chat_id, message_ids, reply_to_message_id=None,
+                               retries=API_MAX_RETRIES, copied=None):
+    """Send storage channel messages to a chat; bundles go out in batched copy calls
+
+    For bundles, copied records what has been sent (see copy_messages), so
+    a retry with the same list skips the batches already delivered.
+    """
+    if len(message_ids) == 1:
+        await scheduler.call(
+            INTERACTIVE,
+            client.copy_message,
+            chat_id=chat_id,
+            from_chat_id=STORAGE_CHANNEL_ID,
+            message_id=message_ids[0],
+            reply_to_message_id=reply_to_message_id,
+            per_chat=chat_id,
+            retries=retries
+        )
+    else:
+        # Shared by the scheduler's retries too
+        copied = [] if copied is None else copied
+        await scheduler.call(
+            INTERACTIVE,
+            copy_messages,
+            client,
+            chat_id,
+            STORAGE_CHANNEL_ID,
+            message_ids,
+            copied,
+            per_chat=chat_id,
+            retries=retries
+        )
+
+def delivery_notice(status, position):
+    """Text telling the user their delivery is delayed or refused, or None if it is on its way"""
+    if status == QUEUED:
+        return f"⏳ Lots of requests right now. Your file is queued (position {position}) and will arrive shortly."
+    if status == FULL:
+        return "🚦 The bot is very busy right now. Please try again in a minute."
+    return None
+
+async def handle_deep_link(client: Client, message: Message) -> bool:
+    """Deliver the file or bundle behind a /start deep link
+
+    Returns False when the message is not a deep link to stored content, so
+    the caller can fall back to its welcome message.
+    """
+    if not message.command or len(message.command) < 2:
+        return False
+
+    start_param = message.command[1]
+    message_ids = await get_deep_link_message_ids(start_param)
+    if not message_ids:
+        return False
+
+    # Check force join
+    if not await is_user_joined(client, message.from_user.id):
+        analytics.record_gate_shown()
+        await scheduler.call(
+            INTERACTIVE,
+            message.reply_text,
+            "To access this content, you need to join our channels first.\n\n"
+            "Please join the channels below and then click 'Try Again'.",
+            reply_markup=get_join_channels_keyboard(FORCE_CHANNELS, start_param),
+            per_chat=message.chat.id
+        )
+        return True
+
+    # Send the file(s) from storage channel; the delivery queue reports failures itself
+    status, position = delivery_queue.submit(
+        client, message.chat.id, message.from_user.id, start_param, message_ids,
+        reply_to_message_id=message.id
+    )
+    notice = delivery_notice(status, position)
+    if notice is not None:
+        await scheduler.call(INTERACTIVE, message.reply_text, notice, per_chat=message.chat.id)
+    return True
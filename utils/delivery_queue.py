@@ -0,0 +1,185 @@
+import asyncio
+import logging
+from pyrogram import Client
+from pyrogram.errors import FloodWait, InternalServerError, ServiceUnavailable
+from config import DELIVERY_WORKERS, DELIVERY_QUEUE_SIZE, DELIVERY_MAX_RETRIES
+from utils.scheduler import scheduler, INTERACTIVE
+from utils.analytics import analytics
+from utils.metrics import metrics, GAUGE
+
+logger = logging.getLogger(__name__)
+
+# Errors worth trying again after a pause; anything else fails the delivery
+TRANSIENT_ERRORS = (InternalServerError, ServiceUnavailable, asyncio.TimeoutError, OSError)
+
+# DeliveryQueue.submit results
+SENDING = "sending"      # a worker picked it up right away
+QUEUED = "queued"        # waiting behind others; position says where
+DUPLICATE = "duplicate"  # the same file is already on its way to this chat
+FULL = "full"            # queue is at DELIVERY_QUEUE_SIZE; try again later
+
+delivery_outcomes = metrics.counter(
+    "bot_deliveries_total", "File deliveries through the delivery queue by outcome", ["outcome"]
+)
+
+class DeliveryQueue:
+    """Bounded queue of file deliveries, sent by a fixed pool of workers
+
+    Update handlers submit a delivery and return at once instead of waiting
+    on Telegram. FloodWaits and transient server errors put the delivery
+    back on the queue after a delay rather than holding a worker, and a
+    file already queued for a chat is not queued twice.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, max_size=DELIVERY_QUEUE_SIZE, max_retries=DELIVERY_MAX_RETRIES):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._queue = None
+        self._tasks = []
+        self._idle = 0
+        # (chat_id, stat_key) of every delivery queued, retrying or in progress
+        self._pending = set()
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def busy(self):
+        return len(self._tasks) - self._idle
+
+    @property
+    def pending(self):
+        """Deliveries accepted but not yet delivered or failed"""
+        return len(self._pending)
+
+    def _ensure_workers(self):
+        """Start the worker pool on first use"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._idle = self.workers
+
+    def submit(self, client: Client, chat_id, user_id, stat_key, message_ids,
+               reply_to_message_id=None, after_gate=False):
+        """Queue a delivery; returns (SENDING | QUEUED | DUPLICATE | FULL, position)"""
+        self._ensure_workers()
+        if (chat_id, stat_key) in self._pending:
+            delivery_outcomes.labels("duplicate").inc()
+            return DUPLICATE, 0
+        if self._queue.qsize() >= self.max_size:
+            delivery_outcomes.labels("rejected").inc()
+            return FULL, 0
+
+        # Workers that are about to pick up earlier jobs don't count as idle
+        position = self._queue.qsize() - self._idle + 1
+        self._pending.add((chat_id, stat_key))
+        self._queue.put_nowait({
+            "client": client,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "stat_key": stat_key,
+            "message_ids": message_ids,
+            "reply_to_message_id": reply_to_message_id,
+            "after_gate": after_gate,
+            "attempt": 0,
+            # Bundle messages already sent, so a retry doesn't repeat them
+            "copied": [],
+        })
+        if position <= 0:
+            return SENDING, 0
+        return QUEUED, position
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self._idle -= 1
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logger.error(f"Error in delivery worker: {str(e)}")
+                self._pending.discard((job["chat_id"], job["stat_key"]))
+            finally:
+                self._idle += 1
+                self._queue.task_done()
+
+    async def _deliver(self, job):
+        """Send one job; on a retryable error, schedule it again instead of waiting here"""
+        # Imported here: utils.delivery submits to this queue
+        from utils.delivery import send_stored_messages
+
+        try:
+            await send_stored_messages(
+                job["client"], job["chat_id"], job["message_ids"],
+                reply_to_message_id=job["reply_to_message_id"], retries=0, copied=job["copied"]
+            )
+        except FloodWait as e:
+            # The scheduler has already paused interactive calls for e.value
+            await self._retry(job, e.value, e)
+            return
+        except TRANSIENT_ERRORS as e:
+            await self._retry(job, 2 ** job["attempt"], e)
+            return
+        except Exception as e:
+            logger.error(f"Error sending file to {job['chat_id']}: {str(e)}")
+            await self._fail(job)
+            return
+
+        self._pending.discard((job["chat_id"], job["stat_key"]))
+        delivery_outcomes.labels("delivered").inc()
+        analytics.record_delivery(job["stat_key"], job["user_id"], after_gate=job["after_gate"])
+
+    async def _retry(self, job, delay, error):
+        if job["attempt"] >= self.max_retries:
+            logger.error(f"Giving up on delivery to {job['chat_id']} after {job['attempt']} retries: {str(error)}")
+            await self._fail(job)
+            return
+        job["attempt"] += 1
+        delivery_outcomes.labels("retried").inc()
+        # Retries skip the size limit: the delivery was already accepted
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+
+    async def _fail(self, job):
+        """Tell the user their delivery failed; it stays pending until they have been told, so drain waits for it"""
+        delivery_outcomes.labels("failed").inc()
+        try:
+            await scheduler.call(
+                INTERACTIVE,
+                job["client"].send_message,
+                job["chat_id"],
+                "❌ Error retrieving the file. Please try again later.",
+                reply_to_message_id=job["reply_to_message_id"],
+                per_chat=job["chat_id"]
+            )
+        except Exception as e:
+            logger.error(f"Error notifying {job['chat_id']} about failed delivery: {str(e)}")
+        finally:
+            self._pending.discard((job["chat_id"], job["stat_key"]))
+
+    async def drain(self, timeout=None):
+        """Wait until nothing is queued, retrying or being sent; False if timeout ran out first"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self._pending:
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def close(self):
+        """Stop the workers; deliveries still queued are dropped"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._idle = 0
+
+    def collect_metrics(self):
+        """Queue gauges for the metrics endpoint"""
+        yield "bot_delivery_queue_length", GAUGE, "Deliveries waiting for a worker", (), [((), len(self))]
+        yield "bot_delivery_workers_busy", GAUGE, "Delivery workers sending right now", (), [((), self.busy)]
+
+# Shared by every handler that delivers files
+delivery_queue = DeliveryQueue()
+metrics.register_collector(delivery_queue.collect_metrics)
@@ -0,0 +1,53 @@
+import asyncio
+
+class PeriodicFlusher:
+    """Background loop behind a write-behind buffer
+
+    Awaits flush() every interval seconds, or sooner when woken, from the
+    first start() until close(). close() never cancels a flush in progress,
+    since that would drop the batch it has taken out of the buffer; it waits
+    for it, then flushes once more so nothing buffered is lost.
+    """
+
+    def __init__(self, flush, interval):
+        self.flush = flush
+        self.interval = interval
+        self._task = None
+        self._wakeup = None
+        self._stopping = False
+
+    def start(self):
+        """Start the loop unless it is already running"""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._loop())
+
+    def wake(self):
+        """Flush now rather than at the end of the interval"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._stopping:
+                await self.flush()
+
+    async def close(self):
+        """Stop the loop, then flush whatever is still buffered and return flush()'s result"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        return await self.flush()
+
+def requeue(pending, batch):
+    """Put a batch whose write failed back into a pending dict; entries buffered since win"""
+    for key, value in batch.items():
+        pending.setdefault(key, value)
@@ -1,29 +1,207 @@
+import asyncio
 import logging
+import time
 from pyrogram import Client
-from config import FORCE_CHANNEL_1, FORCE_CHANNEL_2, ADMIN_ID
-from utils.helpers import get_join_channels_keyboard
-from database import Database
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.errors import UserNotParticipant
+from storage import get_storage
+from config import (
+    FORCE_CHANNELS, ADMIN_ID,
+    MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_NEGATIVE_TTL,
+    MEMBERSHIP_MAX_AGE, MEMBERSHIP_FLUSH_INTERVAL
+)
+from utils.cache import LRUCache, MISSING
+from utils.singleflight import SingleFlight
+from utils.flusher import PeriodicFlusher, requeue
+from utils.scheduler import scheduler, MEMBERSHIP
+from utils.metrics import metrics, GAUGE, COUNTER
 
 logger = logging.getLogger(__name__)
-db = Database()
+db = get_storage()
 
-async def is_user_joined(client: Client, user_id: int) -> bool:
-    """Check if user is a member of both force join channels"""
+JOINED_STATUSES = (
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.OWNER,
+)
+
+# (channel, user_id) -> bool. Members are remembered for longer than
+# non-members so that a user who just joined is re-checked quickly.
+membership_cache = LRUCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_NEGATIVE_TTL)
+
+# Coalesces concurrent checks for the same user (e.g. repeated taps on a link)
+membership_checks = SingleFlight()
+
+membership_answers = metrics.counter(
+    "bot_membership_answers_total", "Force channel membership answers by where they came from", ["source"]
+)
+
+# Chat ID or lower-case username -> FORCE_CHANNELS entry, to match updates
+_configured_channels = {
+    channel if isinstance(channel, int) else channel.lstrip("@").lower(): channel
+    for channel in FORCE_CHANNELS
+}
+
+def force_channel_for(chat):
+    """The FORCE_CHANNELS entry naming chat, or None if it is not a force channel"""
+    channel = _configured_channels.get(chat.id)
+    if channel is None and chat.username:
+        channel = _configured_channels.get(chat.username.lower())
+    return channel
+
+class MembershipIndex:
+    """Force channel membership kept current from chat member updates
+
+    The bot is an admin of the force channels, so Telegram tells it about
+    every join and leave. Those events are buffered here, written to storage
+    in batches, and answer later checks without an API call. "Joined" rows
+    are trusted for up to MEMBERSHIP_MAX_AGE; "left" rows only when this
+    process saw the event, since a join while the bot was down would
+    otherwise lock the user out, and never when the user taps "Try Again",
+    in case their join update was missed or is late. Anything else falls
+    back to get_chat_member.
+    """
+
+    def __init__(self, flush_interval=MEMBERSHIP_FLUSH_INTERVAL, max_age=MEMBERSHIP_MAX_AGE):
+        self.max_age = max_age
+        self.started_at = int(time.time())
+        self._pending = {}  # (channel, user_id) -> (joined, updated_at) not yet stored
+        self._flusher = PeriodicFlusher(self.flush, flush_interval)
+
+    def record(self, channel, user_id, joined, updated_at=None):
+        """Remember a user's membership of a force channel, from an update or a get_chat_member answer"""
+        updated_at = int(time.time()) if updated_at is None else updated_at
+        self._pending[(channel, user_id)] = (joined, updated_at)
+        membership_cache.set(
+            (channel, user_id),
+            joined,
+            ttl=MEMBERSHIP_CACHE_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+        )
+        self._flusher.start()
+
+    async def lookup(self, user_id, channels, trust_left=True):
+        """Trusted local answers for a user's membership of channels, as {channel: joined}
+
+        With trust_left=False only "joined" rows answer.
+        """
+        now = int(time.time())
+        rows = {}
+        if any((channel, user_id) not in self._pending for channel in channels):
+            rows = await db.get_memberships(user_id)
+        answers = {}
+        for channel in channels:
+            row = self._pending.get((channel, user_id)) or rows.get(str(channel))
+            if row is None:
+                continue
+            joined, updated_at = row
+            if (joined and now - updated_at <= self.max_age) or (
+                not joined and trust_left and updated_at >= self.started_at
+            ):
+                answers[channel] = joined
+                membership_cache.set(
+                    (channel, user_id),
+                    joined,
+                    ttl=MEMBERSHIP_CACHE_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+                )
+        return answers
+
+    async def flush(self):
+        """Store the memberships recorded since the last flush in one batch"""
+        if not self._pending:
+            return True
+        batch, self._pending = self._pending, {}
+        entries = [
+            (str(channel), user_id, joined, updated_at)
+            for (channel, user_id), (joined, updated_at) in batch.items()
+        ]
+        if await db.save_memberships(entries):
+            return True
+        # Keep them so the next flush retries; newer records win
+        requeue(self._pending, batch)
+        return False
+
+    async def close(self):
+        """Stop the flush loop and store whatever is still buffered"""
+        return await self._flusher.close()
+
+# Fed by the chat member update handler, read by every force join check
+membership_index = MembershipIndex()
+
+async def is_channel_member(client: Client, channel, user_id: int) -> bool:
+    """Ask Telegram whether user is a member of a single channel"""
+    try:
+        member = await scheduler.call(MEMBERSHIP, client.get_chat_member, channel, user_id)
+        joined = member.status in JOINED_STATUSES
+    except UserNotParticipant:
+        joined = False
+    membership_answers.labels("api").inc()
+
+    if joined:
+        # Leave events keep this current from now on
+        membership_index.record(channel, user_id, True)
+    else:
+        # Not stored: only a leave event seen by this process is trusted
+        # as "not joined", and the user may be joining right now
+        membership_cache.set((channel, user_id), False, ttl=MEMBERSHIP_NEGATIVE_TTL)
+    return joined
+
+async def is_user_joined(client: Client, user_id: int, recheck=False) -> bool:
+    """Check if user is a member of every force join channel
+
+    recheck (for "Try Again") asks Telegram again wherever only a "not
+    joined" answer is known locally.
+    """
     if user_id == ADMIN_ID:
         return True  # Admin bypasses force join
-    
-    try:
-        # Check channel 1
-        member1 = await client.get_chat_member(FORCE_CHANNEL_1, user_id)
-        if member1.status not in ["member", "administrator", "creator"]:
-            return False
-        
-        # Check channel 2
-        member2 = await client.get_chat_member(FORCE_CHANNEL_2, user_id)
-        if member2.status not in ["member", "administrator", "creator"]:
-            return False
-            
-        return True
-    except Exception as e:
-        logger.error(f"Error checking membership for user {user_id}: {str(e)}")
+
+    return await membership_checks.do((user_id, recheck), check_all_channels, client, user_id, recheck)
+
+async def check_all_channels(client: Client, user_id: int, recheck=False) -> bool:
+    """Check every force join channel: cache, then the local index, then Telegram concurrently"""
+    answers = {}
+    for channel in FORCE_CHANNELS:
+        cached = membership_cache.get((channel, user_id))
+        if cached is not MISSING:
+            answers[channel] = cached
+    if len(answers) < len(FORCE_CHANNELS):
+        local = await membership_index.lookup(
+            user_id, [c for c in FORCE_CHANNELS if c not in answers], trust_left=not recheck
+        )
+        membership_answers.labels("index").inc(len(local))
+        answers.update(local)
+    if not all(answers.values()):
+        # One known "not joined" settles it
         return False
+
+    unknown = [channel for channel in FORCE_CHANNELS if channel not in answers]
+    results = await asyncio.gather(
+        *(is_channel_member(client, channel, user_id) for channel in unknown),
+        return_exceptions=True
+    )
+
+    joined = True
+    for channel, result in zip(unknown, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error checking membership of {channel} for user {user_id}: {str(result)}")
+            joined = False
+        elif not result:
+            joined = False
+    return joined
+
+def invalidate_membership(user_id: int):
+    """Forget cached "not joined" answers for a user so the next check looks again"""
+    for channel in FORCE_CHANNELS:
+        if membership_cache.peek((channel, user_id)) is False:
+            membership_cache.invalidate((channel, user_id))
+
+def collect_metrics():
+    """Membership cache and coalescing metrics"""
+    yield "bot_membership_cache_hits_total", COUNTER, "Membership cache hits", (), [((), membership_cache.hits)]
+    yield "bot_membership_cache_misses_total", COUNTER, "Membership cache misses", (), [((), membership_cache.misses)]
+    yield "bot_membership_cache_hit_ratio", GAUGE, "Membership cache hit ratio", (), [((), membership_cache.hit_ratio)]
+    yield "bot_membership_checks_total", COUNTER, "Membership checks run or coalesced by single-flight", ("result",), [
+        (("executed",), membership_checks.executed),
+        (("coalesced",), membership_checks.coalesced),
+    ]
+
+metrics.register_collector(collect_metrics)
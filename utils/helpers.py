@@ -1,40 +1,147 @@
-import uuid
+import base64
+import hashlib
+import hmac
 import logging
+import secrets
+from pyrogram import raw
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from config import LINK_SECRET
 
 logger = logging.getLogger(__name__)
 
+# Telegram accepts at most this many message IDs in one forward call
+MAX_MESSAGES_PER_CALL = 100
+
+# Keys are 16 random URL-safe characters followed by a 4-character
+# checksum, so most guessed keys can be rejected without a lookup. Keys
+# made before checksums were added are 16 lowercase hex characters.
+KEY_RANDOM_LENGTH = 16
+KEY_CHECKSUM_LENGTH = 4
+LEGACY_KEY_CHARS = frozenset("0123456789abcdef")
+
+# "Try Again" buttons carry the start parameter they gate, signed so a
+# tampered button can't be pointed at another key:
+# chk:<start_param>:<signature>, at most 40 of Telegram's 64 bytes
+MEMBERSHIP_CALLBACK_PREFIX = "chk:"
+CALLBACK_SIGNATURE_LENGTH = 8
+MAX_CALLBACK_DATA = 64
+
+def key_checksum(random_part):
+    """Checksum of a key's random part, keyed with LINK_SECRET"""
+    digest = hmac.new(LINK_SECRET.encode(), random_part.encode(), hashlib.blake2s).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:KEY_CHECKSUM_LENGTH]
+
 def generate_unique_key():
     """Generate a unique key for file identification"""
-    return str(uuid.uuid4()).replace("-", "")[:16]
+    random_part = secrets.token_urlsafe(12)[:KEY_RANDOM_LENGTH]
+    return random_part + key_checksum(random_part)
+
+def is_valid_key(unique_key):
+    """Whether a key could have been generated by this bot (checksum or legacy format)"""
+    if len(unique_key) == KEY_RANDOM_LENGTH + KEY_CHECKSUM_LENGTH:
+        random_part = unique_key[:KEY_RANDOM_LENGTH]
+        # Bytes, as compare_digest rejects str with non-ASCII characters
+        return hmac.compare_digest(unique_key[KEY_RANDOM_LENGTH:].encode(), key_checksum(random_part).encode())
+    return len(unique_key) == KEY_RANDOM_LENGTH and LEGACY_KEY_CHARS.issuperset(unique_key)
+
+def callback_signature(payload):
+    """Signature of callback data, keyed with LINK_SECRET"""
+    digest = hmac.new(LINK_SECRET.encode(), b"callback:" + payload.encode(), hashlib.blake2s).digest()
+    return base64.urlsafe_b64encode(digest).decode()[:CALLBACK_SIGNATURE_LENGTH]
+
+def membership_callback_data(start_param):
+    """callback_data for a "Try Again" button that delivers start_param once the user has joined"""
+    data = f"{MEMBERSHIP_CALLBACK_PREFIX}{start_param}:{callback_signature(start_param)}"
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"Start parameter too long for callback data: {start_param}")
+    return data
+
+def get_start_param_from_callback_data(data):
+    """The start parameter in "Try Again" callback data, or None if it is not ours or was tampered with"""
+    if not data.startswith(MEMBERSHIP_CALLBACK_PREFIX):
+        return None
+    start_param, _, signature = data[len(MEMBERSHIP_CALLBACK_PREFIX):].rpartition(":")
+    if not start_param or not hmac.compare_digest(signature.encode(), callback_signature(start_param).encode()):
+        return None
+    return start_param
 
 def create_deep_link(bot_username, unique_key):
     """Create a deep link for file access"""
     return f"https://t.me/{bot_username}?start=FILE_{unique_key}"
 
+def create_bundle_link(bot_username, unique_key):
+    """Create a deep link for a multi-file bundle"""
+    return f"https://t.me/{bot_username}?start=BUNDLE_{unique_key}"
+
 def get_unique_key_from_start_param(start_param):
     """Extract unique key from start parameter"""
     if start_param.startswith("FILE_"):
         return start_param[5:]
     return None
 
-def get_join_channels_keyboard(force_channel_1, force_channel_2):
-    """Create inline keyboard for force join channels"""
+def get_bundle_key_from_start_param(start_param):
+    """Extract bundle key from start parameter"""
+    if start_param.startswith("BUNDLE_"):
+        return start_param[7:]
+    return None
+
+def get_join_channels_keyboard(force_channels, start_param):
+    """Create inline keyboard for force join channels, retrying the delivery of start_param"""
     buttons = []
     
-    # Add channel 1 button
-    if force_channel_1.startswith("@"):
-        buttons.append([InlineKeyboardButton("Join Channel 1", url=f"https://t.me/{force_channel_1[1:]}")])
-    else:
-        buttons.append([InlineKeyboardButton("Join Channel 1", url=f"https://t.me/c/{force_channel_1}")])
-    
-    # Add channel 2 button
-    if force_channel_2.startswith("@"):
-        buttons.append([InlineKeyboardButton("Join Channel 2", url=f"https://t.me/{force_channel_2[1:]}")])
-    else:
-        buttons.append([InlineKeyboardButton("Join Channel 2", url=f"https://t.me/c/{force_channel_2}")])
+    # Add one join button per channel
+    for i, channel in enumerate(force_channels, start=1):
+        channel = str(channel)
+        if channel.startswith("@"):
+            buttons.append([InlineKeyboardButton(f"Join Channel {i}", url=f"https://t.me/{channel[1:]}")])
+        else:
+            buttons.append([InlineKeyboardButton(f"Join Channel {i}", url=f"https://t.me/c/{channel}")])
     
     # Add try again button
-    buttons.append([InlineKeyboardButton("Try Again", callback_data="check_membership")])
+    buttons.append([InlineKeyboardButton("Try Again", callback_data=membership_callback_data(start_param))])
     
     return InlineKeyboardMarkup(buttons)
+
+def get_file_name(message):
+    """Describe the file in a message for listings"""
+    media = message.document or message.video or message.audio
+    if media is not None and media.file_name:
+        return media.file_name
+    if message.photo:
+        return "Photo"
+    return (message.caption or "File")[:50]
+
+async def copy_messages(client, chat_id, from_chat_id, message_ids, copied=None):
+    """Copy messages without the forward header, up to MAX_MESSAGES_PER_CALL per API call
+
+    Returns the new message IDs in the same order as message_ids, with None
+    for any message Telegram did not copy. They are collected in copied as
+    each call succeeds; passing the same list again after an error resumes
+    with the first batch that was not sent, instead of sending earlier
+    batches twice.
+    """
+    to_peer = await client.resolve_peer(chat_id)
+    from_peer = await client.resolve_peer(from_chat_id)
+    copied = [] if copied is None else copied
+    
+    for i in range(len(copied), len(message_ids), MAX_MESSAGES_PER_CALL):
+        batch = list(message_ids[i:i + MAX_MESSAGES_PER_CALL])
+        random_ids = [client.rnd_id() for _ in batch]
+        updates = await client.invoke(
+            raw.functions.messages.ForwardMessages(
+                to_peer=to_peer,
+                from_peer=from_peer,
+                id=batch,
+                random_id=random_ids,
+                drop_author=True
+            )
+        )
+        # UpdateMessageID ties each of our random_ids to the new message
+        new_ids = {
+            update.random_id: update.id
+            for update in updates.updates
+            if isinstance(update, raw.types.UpdateMessageID)
+        }
+        copied.extend(new_ids.get(random_id) for random_id in random_ids)
+    
+    return copied
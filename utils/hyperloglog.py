@@ -0,0 +1,51 @@
+import math
+
+MASK64 = (1 << 64) - 1
+
+def mix64(value):
+    """splitmix64 finalizer: spreads an integer's bits over all 64 so nearby IDs hash far apart"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+class HyperLogLog:
+    """Fixed-size estimate of how many distinct integers have been added
+
+    2**precision one-byte registers; the default of 10 uses 1 KiB and is
+    accurate to about 3%. Sketches with the same precision merge by taking
+    the larger of each pair of registers, so partial counts can be combined
+    in any order, any number of times.
+    """
+
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self._rest_bits = 64 - precision
+        self._rest_mask = (1 << self._rest_bits) - 1
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value):
+        """Record an integer, e.g. a user ID"""
+        hashed = mix64(value)
+        index = hashed >> self._rest_bits
+        # Position of the leftmost 1 bit in the remaining bits
+        rank = self._rest_bits - (hashed & self._rest_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, registers):
+        """Fold another sketch's registers into this one"""
+        if registers:
+            self.registers = bytearray(map(max, self.registers, registers))
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small-range correction (linear counting)
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from pyrogram import Client
+from storage import get_storage
+from config import ADMIN_ID, STORAGE_CHANNEL_ID, SWEEP_INTERVAL, SWEEP_BATCH_SIZE, SWEEP_RATE, LEASE_TTL
+from utils.rate_limiter import TokenBucket
+from utils.scheduler import scheduler, MAINTENANCE, PROGRESS
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+db = get_storage()
+
+# Telegram returns at most this many messages per get_messages call
+MAX_MESSAGES_PER_CALL = 200
+
+# Held by the process sweeping; the others wait
+SWEEP_LEASE = "sweep"
+
+swept_files = metrics.counter(
+    "bot_sweep_files_total", "Files checked by the storage integrity sweep by outcome", ["outcome"]
+)
+
+class IntegritySweep:
+    """Periodic check that every stored file's message still exists
+
+    Files are read from storage in chunks and their storage channel messages
+    fetched up to 200 per get_messages call, in the scheduler's lowest
+    priority class and under a separate rate budget, so live traffic always
+    goes first. Files whose message is gone are flagged dead, and their
+    links are treated as unknown straight away instead of failing in
+    copy_message. Progress is stored after every chunk, so a restart
+    continues the sweep it interrupted, and waits out the rest of the
+    interval after a completed one instead of sweeping again. With several
+    processes only the one holding the sweep lease sweeps.
+    """
+
+    def __init__(self, interval=SWEEP_INTERVAL, batch_size=SWEEP_BATCH_SIZE, rate=SWEEP_RATE):
+        self.interval = interval
+        self.batch_size = max(1, min(batch_size, MAX_MESSAGES_PER_CALL))
+        self.bucket = TokenBucket(rate)
+        self._task = None
+
+    def start(self, client: Client):
+        """Sweep every interval seconds in the background, counting from the last completed sweep"""
+        if self.interval <= 0 or (self._task is not None and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._loop(client))
+
+    async def _loop(self, client: Client):
+        while True:
+            state = await db.get_sweep_state()
+            if state is not None and state["finished_at"] is not None:
+                await asyncio.sleep(max(0.0, state["finished_at"] + self.interval - time.time()))
+            if await self.run(client) is None:
+                # Another process is sweeping; look again once its lease could have lapsed
+                await asyncio.sleep(LEASE_TTL)
+
+    async def run(self, client: Client):
+        """Check every live file once, continuing an interrupted sweep
+
+        Returns (checked, dead), or None if another process holds the sweep lease.
+        """
+        if not await db.acquire_lease(SWEEP_LEASE):
+            return None
+        state = await db.get_sweep_state()
+        if state is None or state["finished_at"] is not None:
+            state = {"cursor": None, "started_at": int(time.time()), "finished_at": None, "checked": 0, "dead": 0}
+        else:
+            logger.info(f"Resuming integrity sweep after {state['checked']} files")
+
+        async for chunk, cursor in db.iter_files(chunk_size=self.batch_size * 5, cursor=state["cursor"]):
+            for i in range(0, len(chunk), self.batch_size):
+                batch = chunk[i:i + self.batch_size]
+                missing = await self.check_batch(client, batch)
+                if missing is None:
+                    continue
+                state["checked"] += len(batch)
+                if missing:
+                    await db.mark_files_dead(missing)
+                    state["dead"] += len(missing)
+            if cursor is not None:
+                if not await db.acquire_lease(SWEEP_LEASE):
+                    logger.warning("Integrity sweep was taken over by another process; stopped")
+                    return None
+                state["cursor"] = cursor
+                await db.save_sweep_state(state)
+
+        state["cursor"] = None
+        state["finished_at"] = int(time.time())
+        await db.save_sweep_state(state)
+        await db.release_lease(SWEEP_LEASE)
+        checked, dead = state["checked"], state["dead"]
+        logger.info(
+            f"Integrity sweep checked {checked} files in {state['finished_at'] - state['started_at']}s; {dead} dead"
+        )
+        if dead:
+            try:
+                await scheduler.call(
+                    PROGRESS,
+                    client.send_message,
+                    ADMIN_ID,
+                    f"🧹 Storage sweep: {dead} of {checked} files are gone from the storage channel. "
+                    "Their links are now treated as unknown.",
+                    per_chat=ADMIN_ID
+                )
+            except Exception as e:
+                logger.error(f"Error notifying admin about sweep: {str(e)}")
+        return checked, dead
+
+    async def check_batch(self, client: Client, batch):
+        """Fetch a batch's messages in one call; returns the entries whose message is gone, or None on error"""
+        await self.bucket.acquire()
+        try:
+            messages = await scheduler.call(
+                MAINTENANCE,
+                client.get_messages,
+                STORAGE_CHANNEL_ID,
+                [message_id for _, message_id in batch]
+            )
+        except Exception as e:
+            # Nothing is flagged on errors: losing access to the channel must
+            # not look like every message being deleted
+            swept_files.labels("error").inc(len(batch))
+            logger.error(f"Error checking {len(batch)} storage messages: {str(e)}")
+            return None
+
+        alive = {message.id for message in messages if message is not None and not message.empty}
+        missing = [entry for entry in batch if entry[1] not in alive]
+        swept_files.labels("alive").inc(len(batch) - len(missing))
+        swept_files.labels("dead").inc(len(missing))
+        return missing
+
+    async def close(self):
+        """Stop sweeping; a sweep in progress continues after its last stored chunk next time"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            # Let another process continue the sweep without waiting for the lease to lapse
+            await db.release_lease(SWEEP_LEASE)
+
+# Started from main once the client is connected
+integrity_sweep = IntegritySweep()
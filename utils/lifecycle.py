@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from pyrogram import Client
+from storage import get_storage
+from config import METRICS_HOST, METRICS_PORT, CACHE_WARM_SIZE, SHUTDOWN_DEADLINE, SHUTDOWN_DISCONNECT_TIMEOUT
+from utils.metrics import start_metrics_server
+from utils.analytics import analytics
+from utils.delivery_queue import delivery_queue
+from utils.integrity import integrity_sweep
+from utils.force_join import membership_index
+
+logger = logging.getLogger(__name__)
+
+class Lifecycle:
+    """Starts the bot's background work and shuts it all down in order
+
+    Shutdown stops taking updates first, then gives in-flight deliveries
+    and a running broadcast until the deadline to finish or checkpoint,
+    flushes every write buffer and only then disconnects, so a restart
+    neither loses nor replays work that had already been accepted.
+    """
+
+    def __init__(self, client: Client, broadcast, deadline=SHUTDOWN_DEADLINE):
+        self.client = client
+        self.broadcast = broadcast
+        self.deadline = deadline
+        self._metrics_server = None
+        self._warm_up_task = None
+        self._resume_task = None
+
+    async def start(self):
+        """Connect, then start serving metrics, warming caches and resuming interrupted work"""
+        await self.client.start()
+        self._metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        # Loads in the background; lookups skip the filter until it is ready
+        self._warm_up_task = asyncio.create_task(self._warm_up())
+        # Takes over broadcasts whose process stopped; runs alongside the others
+        self._resume_task = asyncio.create_task(self.broadcast.resume_loop(self.client))
+        integrity_sweep.start(self.client)
+
+    async def _warm_up(self):
+        """Load the key filter, then the most delivered links into the lookup caches"""
+        storage = get_storage()
+        await storage.load_key_filter()
+        await storage.warm_caches(CACHE_WARM_SIZE)
+
+    async def shutdown(self):
+        """Drain and flush everything, then disconnect; returns a report of what was kept"""
+        started = time.monotonic()
+        report = {}
+
+        # 1. No new updates; handlers already running finish (they only queue work)
+        try:
+            await asyncio.wait_for(self.client.dispatcher.stop(), self.deadline)
+        except asyncio.TimeoutError:
+            logger.warning("Update handlers still running at the shutdown deadline; cancelling them")
+            # client.stop() would otherwise wait for them again, without a deadline
+            handlers = self.client.dispatcher.handler_worker_tasks
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            handlers.clear()
+        self._warm_up_task.cancel()
+        self._resume_task.cancel()
+        await asyncio.gather(self._warm_up_task, self._resume_task, return_exceptions=True)
+        await integrity_sweep.close()
+
+        # 2. Deliveries and the broadcast share what is left of the deadline
+        remaining = max(0.0, self.deadline - (time.monotonic() - started))
+        queued = delivery_queue.pending
+        _, report["broadcast"] = await asyncio.gather(
+            delivery_queue.drain(remaining),
+            self.broadcast.checkpoint_for_shutdown(remaining)
+        )
+        report["deliveries_abandoned"] = delivery_queue.pending
+        report["deliveries_drained"] = queued - report["deliveries_abandoned"]
+        await delivery_queue.close()
+
+        # 3. Buffered writes, most of them flushed on a timer while running
+        report["users_flushed"] = await get_storage().flush_users()
+        report["analytics_flushed"] = await analytics.close()
+        report["memberships_flushed"] = await membership_index.close()
+
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        try:
+            await asyncio.wait_for(self.client.stop(), SHUTDOWN_DISCONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Client did not disconnect within {SHUTDOWN_DISCONNECT_TIMEOUT}s")
+        await get_storage().close()
+
+        report["seconds"] = round(time.monotonic() - started, 1)
+        log = logger.warning if report["deliveries_abandoned"] or report["broadcast"] == "abandoned" else logger.info
+        log(
+            f"Shutdown in {report['seconds']}s: {report['deliveries_drained']} deliveries drained, "
+            f"{report['deliveries_abandoned']} abandoned; broadcast {report['broadcast']}; "
+            f"{report['users_flushed']} users flushed, analytics "
+            f"{'flushed' if report['analytics_flushed'] else 'NOT flushed'}, memberships "
+            f"{'flushed' if report['memberships_flushed'] else 'NOT flushed'}"
+        )
+        return report
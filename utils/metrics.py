@@ -0,0 +1,245 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cache hit up to a FloodWait-sized stall
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Kinds of collector samples: a counter only goes up (and resets on restart)
+GAUGE = "gauge"
+COUNTER = "counter"
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Return the child for one combination of label values
+
+        Look children up once and keep them on hot paths; the lookup itself
+        is a dict access.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(_format_labels(self.labelnames, values), values, child))
+        return lines
+
+class Counter(_Metric):
+    """Monotonic counter, optionally split by labels"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_child(self, labels, values, child):
+        return [f"{self.name}{labels} {child.value}"]
+
+class Histogram(_Metric):
+    """Latency histogram with fixed buckets, optionally split by labels"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render_child(self, labels, values, child):
+        lines = []
+        cumulative = 0
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, child.counts):
+            cumulative += count
+            bucket_labels = _format_labels(self.labelnames + ("le",), values + (bound,))
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {child.sum}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class MetricsRegistry:
+    """Holds every metric and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """Add a callable that returns samples at scrape time
+
+        It must return an iterable of (name, kind, documentation, labelnames,
+        [(label_values, value), ...]), kind being GAUGE or COUNTER; counter
+        names end in _total. Snapshots of counters that already live
+        elsewhere (cache hits, scheduler queues) are read this way so the
+        hot path pays nothing for them.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                for name, kind, documentation, labelnames, samples in collector():
+                    lines.append(f"# HELP {name} {documentation}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for values, value in samples:
+                        lines.append(f"{name}{_format_labels(labelnames, values)} {value}")
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+# Shared by every module that records metrics
+metrics = MetricsRegistry()
+
+handler_latency = metrics.histogram(
+    "bot_handler_duration_seconds", "Time spent in update handlers", ["handler"]
+)
+handler_errors = metrics.counter(
+    "bot_handler_errors_total", "Update handlers that raised", ["handler"]
+)
+db_latency = metrics.histogram(
+    "bot_db_duration_seconds", "Time spent in storage methods, including cache hits", ["method"]
+)
+api_latency = metrics.histogram(
+    "bot_api_duration_seconds", "Time spent in outbound Telegram API calls", ["method"]
+)
+api_queue_latency = metrics.histogram(
+    "bot_api_queue_seconds", "Time outbound API calls waited in the scheduler", ["priority"]
+)
+api_errors = metrics.counter(
+    "bot_api_errors_total", "Outbound Telegram API calls that raised", ["method", "error"]
+)
+rejected_lookups = metrics.counter(
+    "bot_rejected_lookups_total", "Deep-link keys rejected without a storage query", ["reason"]
+)
+broadcast_messages = metrics.counter(
+    "bot_broadcast_messages_total", "Broadcast deliveries by outcome", ["outcome"]
+)
+
+def timed(histogram, label=None, errors=None):
+    """Decorator recording an async function's latency in histogram
+
+    The label value defaults to the function name. If an errors counter is
+    given, exceptions are counted there under the same label.
+    """
+    def decorator(func):
+        name = label or func.__name__
+        child = histogram.labels(name)
+        error_child = errors.labels(name) if errors is not None else None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                if error_child is not None:
+                    error_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+async def _handle_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Drain the headers; the request path is not inspected
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        if request.startswith(b"GET "):
+            body = metrics.render().encode()
+            status = "200 OK"
+        else:
+            body = b"Method not allowed\n"
+            status = "405 Method Not Allowed"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {str(e)}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(host, port):
+    """Serve the metrics over HTTP for Prometheus to scrape; returns the server, or None if disabled"""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_handle_scrape, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+    except Exception as e:
+        logger.error(f"Error starting metrics server: {str(e)}")
+        return None
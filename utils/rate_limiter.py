@@ -0,0 +1,89 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    """Async token bucket shared by any number of coroutines"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# UserRateLimiter.check results
+ALLOW = "allow"
+NOTIFY = "notify"  # over the limit; tell the user once
+DROP = "drop"      # over the limit and already told
+
+class UserRateLimiter:
+    """Per-user token buckets with bounded memory
+
+    Each user may send `burst` messages at once and `rate` per second after
+    that. Buckets are kept in least-recently-seen order: users idle for
+    `idle_timeout` seconds (whose buckets are full again anyway) are
+    evicted as new users arrive, and at most `max_users` are tracked.
+    """
+
+    def __init__(self, rate, burst, max_users=100000, idle_timeout=600):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        # user_id -> [tokens, last_seen, notified]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, user_id):
+        """Take a token for user_id and return ALLOW, NOTIFY or DROP"""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._evict(now)
+            bucket = self._buckets[user_id] = [self.burst, now, False]
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return ALLOW
+        if bucket[2]:
+            return DROP
+        bucket[2] = True
+        return NOTIFY
+
+    def cooldown(self, user_id):
+        """Seconds until user_id may send again"""
+        bucket = self._buckets.get(user_id)
+        if bucket is None or bucket[0] >= 1:
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def _evict(self, now):
+        """Drop idle users from the least recently seen end, and the oldest if still full"""
+        buckets = self._buckets
+        while buckets:
+            user_id, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self.idle_timeout and len(buckets) < self.max_users:
+                break
+            del buckets[user_id]
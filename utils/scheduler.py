@@ -0,0 +1,184 @@
+import asyncio
+import time
+import logging
+from collections import OrderedDict, deque
+from pyrogram.errors import FloodWait
+from utils.metrics import metrics, api_latency, api_queue_latency, api_errors, GAUGE, COUNTER
+from config import API_GLOBAL_RATE, API_PER_CHAT_INTERVAL, API_MAX_RETRIES, API_MAX_FLOOD_WAIT
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+INTERACTIVE = 0  # file deliveries and replies to users
+MEMBERSHIP = 1   # force-join get_chat_member checks
+BROADCAST = 2    # broadcast sends
+PROGRESS = 3     # broadcast progress edits and other background chatter
+MAINTENANCE = 4  # storage channel integrity sweeps
+
+PRIORITY_NAMES = {
+    INTERACTIVE: "interactive",
+    MEMBERSHIP: "membership",
+    BROADCAST: "broadcast",
+    PROGRESS: "progress",
+    MAINTENANCE: "maintenance",
+}
+
+# How many chats to remember per-chat send times for
+MAX_TRACKED_CHATS = 100000
+
+class ApiScheduler:
+    """Single gate for outbound Telegram API calls
+
+    Calls share one global token bucket; when several are waiting, the most
+    urgent priority class gets the next token. Calls to the same chat are
+    spaced at least per_chat_interval apart, and a FloodWait pauses only the
+    class that hit it.
+    """
+
+    def __init__(self, rate=API_GLOBAL_RATE, per_chat_interval=API_PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.per_chat_interval = per_chat_interval
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters = {priority: deque() for priority in PRIORITY_NAMES}
+        self._paused_until = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._chat_next = OrderedDict()
+        self._dispatcher = None
+        self._wakeup = None
+        self.calls = {priority: 0 for priority in PRIORITY_NAMES}
+        self.flood_waits = {priority: 0 for priority in PRIORITY_NAMES}
+
+    def pause(self, priority, seconds):
+        """Stop granting tokens to a priority class for the given number of seconds"""
+        self._paused_until[priority] = max(self._paused_until[priority], time.monotonic() + seconds)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def call(self, priority, func, *args, per_chat=None, retries=API_MAX_RETRIES, **kwargs):
+        """Run func(*args, **kwargs) once the scheduler allows it
+
+        per_chat names the chat the call sends to, for per-chat spacing.
+        A FloodWait pauses the priority class and the call is retried up to
+        retries times, as long as the wait is at most API_MAX_FLOOD_WAIT.
+        """
+        method = getattr(func, "__name__", "call")
+        latency = api_latency.labels(method)
+        queue_latency = api_queue_latency.labels(PRIORITY_NAMES[priority])
+        attempt = 0
+        while True:
+            queued = time.perf_counter()
+            if per_chat is not None:
+                await self._wait_for_chat(per_chat)
+            await self._acquire(priority)
+            self.calls[priority] += 1
+            started = time.perf_counter()
+            queue_latency.observe(started - queued)
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                api_errors.labels(method, "FloodWait").inc()
+                self.flood_waits[priority] += 1
+                logger.warning(f"FloodWait of {e.value}s on {PRIORITY_NAMES[priority]} call; pausing that class")
+                self.pause(priority, e.value)
+                if attempt >= retries or e.value > API_MAX_FLOOD_WAIT:
+                    raise
+                attempt += 1
+            except Exception as e:
+                api_errors.labels(method, type(e).__name__).inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+    async def _wait_for_chat(self, chat_id):
+        """Reserve the next send slot for chat_id and sleep until it comes up"""
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        self._chat_next.move_to_end(chat_id)
+        while len(self._chat_next) > MAX_TRACKED_CHATS:
+            self._chat_next.popitem(last=False)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _acquire(self, priority):
+        """Queue for a global token in the given priority class"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    def _next_waiter(self, now):
+        """Pop the first live waiter of the most urgent unpaused class"""
+        for priority, waiters in self._waiters.items():
+            if self._paused_until[priority] > now:
+                continue
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    return future
+        return None
+
+    async def _dispatch(self):
+        """Hand out tokens to waiters in priority order"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                future = self._next_waiter(now)
+                if future is not None:
+                    self._tokens -= 1
+                    future.set_result(None)
+                    continue
+                # Nothing grantable: sleep until the earliest paused class resumes
+                # (if anything is waiting there) or until a new waiter arrives
+                timeout = None
+                resumes = [
+                    self._paused_until[priority] - now
+                    for priority, waiters in self._waiters.items()
+                    if waiters and self._paused_until[priority] > now
+                ]
+                if resumes:
+                    timeout = min(resumes)
+            else:
+                timeout = (1 - self._tokens) / self.rate
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        """Return a snapshot of per-class counters and queue lengths"""
+        now = time.monotonic()
+        return {
+            name: {
+                "calls": self.calls[priority],
+                "flood_waits": self.flood_waits[priority],
+                "waiting": len(self._waiters[priority]),
+                "paused_for": max(0.0, self._paused_until[priority] - now),
+            }
+            for priority, name in PRIORITY_NAMES.items()
+        }
+
+    def collect_metrics(self):
+        """Scheduler counters and gauges for the metrics endpoint"""
+        stats = self.stats()
+        for field, name, kind, documentation in (
+            ("calls", "bot_scheduler_calls_total", COUNTER, "Outbound API calls granted per priority class"),
+            ("flood_waits", "bot_scheduler_flood_waits_total", COUNTER, "FloodWait errors per priority class"),
+            ("waiting", "bot_scheduler_waiting", GAUGE, "Calls queued per priority class"),
+            ("paused_for", "bot_scheduler_paused_for", GAUGE, "Seconds until a paused priority class resumes"),
+        ):
+            samples = [((priority,), values[field]) for priority, values in stats.items()]
+            yield name, kind, documentation, ("priority",), samples
+
+# Shared by every module that talks to Telegram
+scheduler = ApiScheduler()
+metrics.register_collector(scheduler.collect_metrics)
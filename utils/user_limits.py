@@ -0,0 +1,55 @@
+import logging
+from pyrogram import Client
+from pyrogram.types import Message
+from config import (
+    ADMIN_ID, USER_MESSAGE_RATE, USER_MESSAGE_BURST, USER_LIMITER_SIZE, USER_LIMITER_IDLE
+)
+from utils.rate_limiter import UserRateLimiter, ALLOW, NOTIFY
+from utils.scheduler import scheduler, INTERACTIVE
+from utils.metrics import metrics, GAUGE
+
+logger = logging.getLogger(__name__)
+
+user_limiter = UserRateLimiter(USER_MESSAGE_RATE, USER_MESSAGE_BURST, USER_LIMITER_SIZE, USER_LIMITER_IDLE)
+
+shed_messages = metrics.counter(
+    "bot_shed_messages_total", "Private messages ignored by the per-user rate limit", ["action"]
+)
+shed_dropped = shed_messages.labels("dropped")
+shed_notified = shed_messages.labels("notified")
+
+async def allow_message(client: Client, message: Message) -> bool:
+    """Apply the per-user rate limit before any storage or API work
+
+    Returns False if the message should be ignored. The first message over
+    the limit gets a single cooldown notice; the rest are dropped silently.
+    """
+    user_id = message.from_user.id
+    if user_id == ADMIN_ID:
+        return True
+
+    decision = user_limiter.check(user_id)
+    if decision == ALLOW:
+        return True
+
+    if decision == NOTIFY:
+        shed_notified.inc()
+        try:
+            await scheduler.call(
+                INTERACTIVE,
+                message.reply_text,
+                f"⏳ You're sending messages too fast. Please wait {user_limiter.cooldown(user_id):.0f} "
+                "seconds and try again.",
+                per_chat=message.chat.id
+            )
+        except Exception as e:
+            logger.error(f"Error sending cooldown notice to {user_id}: {str(e)}")
+    else:
+        shed_dropped.inc()
+    return False
+
+def collect_metrics():
+    """Per-user limiter gauges"""
+    yield "bot_rate_limited_users", GAUGE, "Users tracked by the per-user rate limiter", (), [((), len(user_limiter))]
+
+metrics.register_collector(collect_metrics)